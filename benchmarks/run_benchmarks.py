@@ -0,0 +1,305 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Benchmark of the wine ETL and Airbnb analysis pipelines over synthetic data.
+Every (pipeline, size) runs in its own process, so the peak RSS is not inherited from previous runs.
+
+python run_benchmarks.py --sizes 10k 1m --output results.json --compare previous.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, "data-engineering"))
+sys.path.insert(0, os.path.join(ROOT, "data-science"))
+
+import synthetic_data
+
+SIZES = {"10k": 10000, "1m": 1000000, "10m": 10000000}
+
+# Seconds between checks that a benchmark process is still alive while waiting for its results
+POLL_SECONDS = 1.0
+
+CLI = os.path.join(ROOT, "cli.py")
+
+# Commands timed in a fresh interpreter by --startup, {db} is the wines database of the largest size run
+STARTUP_COMMANDS = {
+    "import wines_dataset_jcps": ["-c", "import wines_dataset_jcps"],
+    "import airbnb_dataset_jcps": ["-c", "import airbnb_dataset_jcps"],
+    "cli --help": [CLI, "--help"],
+    "cli wines stats": [CLI, "wines", "stats", "--db", "{db}"]
+}
+
+# Libraries whose import dominates startup, reported when a command imports them
+HEAVY_MODULES = {"numpy", "pandas", "pyarrow", "scipy", "matplotlib", "seaborn"}
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far (ru_maxrss is in KB on linux, bytes on macOS).
+    :return: MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def failure(stage, rows, error, peak_rss=None):
+    """
+    Result of a stage that could not run.
+    :return: stage result
+    """
+    return {"stage": stage, "rows": rows, "seconds": 0.0, "rows_per_sec": None, "peak_rss_mb": peak_rss,
+            "error": error}
+
+
+def timed(results, stage, rows, function, *args):
+    """
+    Run one stage quietly and record its time, throughput and peak RSS.
+    :return: stage return value
+    """
+    value = None
+    error = None
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            value = function(*args)
+    except Exception as e:
+        error = repr(e)
+    seconds = time.perf_counter() - start
+    results.append({
+        "stage": stage,
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rows_per_sec": round(rows / seconds, 1) if seconds else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "error": error
+    })
+    return value
+
+
+def bench_wines(csv_file, rows, workdir, results):
+    """
+    Wine ETL stages, from the csv to the star schema.
+    :param results: list the stage results are appended to
+    :return:
+    """
+    from wines_dataset_jcps import STAR_SCHEMA_TABLES, WinesDataset, sql_create_staging_wines_table
+
+    dataset = timed(results, "read_csv", rows, WinesDataset, csv_file)
+    dataset.create_db_connection(os.path.join(workdir, f"wines_{rows}.db"))
+    for table in [sql_create_staging_wines_table] + STAR_SCHEMA_TABLES:
+        dataset.create_db_table(table)
+
+    timed(results, "get_csv_data_types", rows, dataset.get_csv_data_types)
+    timed(results, "load_csv_into_table", rows, dataset.load_csv_into_table, "staging_wines")
+    timed(results, "populate_dim_tables", rows, dataset.populate_dim_tables)
+    timed(results, "populate_fact_table", rows, dataset.populate_fact_table)
+    dataset.close_db_connection()
+
+
+def bench_airbnb(csv_file, rows, workdir, results):
+    """
+    Airbnb analysis stages.
+    :param results: list the stage results are appended to
+    :return:
+    """
+    from airbnb_dataset_jcps import AirbnbDataset
+
+    dataset = timed(results, "read_csv", rows, AirbnbDataset, csv_file)
+    timed(results, "clean_dataset", rows, dataset.clean_dataset)
+    timed(results, "get_correlation", rows, dataset.get_correlation)
+    timed(results, "get_ordered_correlations", rows, dataset.get_ordered_correlations)
+
+
+PIPELINES = {
+    "wines": (synthetic_data.wines_frame, bench_wines),
+    "airbnb": (synthetic_data.airbnb_frame, bench_airbnb)
+}
+
+
+def run_pipeline(pipeline, rows, workdir, seed, results_queue):
+    """
+    Child process entry point: generate (or reuse) the synthetic csv and benchmark the pipeline.
+    The stage results are always sent back, with a "pipeline" failure when a stage could not run
+    (e.g. after read_csv failed).
+    :return:
+    """
+    results = []
+    try:
+        generator, bench = PIPELINES[pipeline]
+        csv_file = os.path.join(workdir, f"{pipeline}_{rows}_{seed}.csv")
+        if not os.path.exists(csv_file):
+            synthetic_data.write_csv(generator, csv_file, rows, seed)
+        bench(csv_file, rows, workdir, results)
+    except Exception as e:
+        results.append(failure("pipeline", rows, repr(e), round(peak_rss_mb(), 1)))
+    finally:
+        results_queue.put(results)
+
+
+def collect(process, results_queue, rows):
+    """
+    Wait for the results of a benchmark process without hanging if it dies first (killed by the OOM
+    killer on the large sizes, for instance).
+    :return: list of stage results
+    """
+    while True:
+        try:
+            return results_queue.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            if not process.is_alive():
+                break
+    try:
+        # Results put just before the process exited
+        return results_queue.get(timeout=POLL_SECONDS)
+    except queue.Empty:
+        return [failure("pipeline", rows, f"benchmark process died with exit code {process.exitcode}")]
+
+
+def bench_startup(db, repeat=5):
+    """
+    Wall time (median of repeat runs) of the STARTUP_COMMANDS, and the heavy libraries each one imports
+    (from a -X importtime run).
+    :param db: wines database for the stats command, skipped if missing
+    :param repeat:
+    :return: list of stage results
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "data-engineering"),
+                                                       os.path.join(ROOT, "data-science")]))
+    results = []
+    for stage, arguments in STARTUP_COMMANDS.items():
+        if "{db}" in arguments and not os.path.exists(db):
+            continue
+        command = [sys.executable] + [argument.format(db=db) for argument in arguments]
+
+        times = []
+        error = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            completed = subprocess.run(command, env=env, capture_output=True, text=True)
+            times.append(time.perf_counter() - start)
+            if completed.returncode:
+                error = (completed.stderr.strip().splitlines() or ["failed"])[-1]
+                break
+
+        traced = subprocess.run(command[:1] + ["-X", "importtime"] + command[1:], env=env,
+                                capture_output=True, text=True)
+        imported = {line.rsplit("|", 1)[-1].strip().split(".")[0]
+                    for line in traced.stderr.splitlines() if line.startswith("import time:")}
+        results.append({
+            "pipeline": "startup",
+            "stage": stage,
+            "rows": 0,
+            "seconds": round(statistics.median(times), 4),
+            "rows_per_sec": None,
+            "peak_rss_mb": None,
+            "error": error,
+            "heavy_modules": sorted(imported & HEAVY_MODULES)
+        })
+    return results
+
+
+def compare(current, previous):
+    """
+    Print the time ratio of every stage against a previous run.
+    :param current: results dict
+    :param previous: results dict
+    :return:
+    """
+    before = {(r["pipeline"], r["rows"], r["stage"]): r for r in previous["results"]}
+    print(f"{'pipeline':8} {'rows':>10} {'stage':26} {'before':>9} {'now':>9} {'ratio':>7}")
+    for r in current["results"]:
+        old = before.get((r["pipeline"], r["rows"], r["stage"]))
+        if old is None or not old["seconds"]:
+            continue
+        print(f"{r['pipeline']:8} {r['rows']:>10} {r['stage']:26} {old['seconds']:>9.3f} {r['seconds']:>9.3f} "
+              f"{r['seconds'] / old['seconds']:>7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=["10k"])
+    parser.add_argument("--pipelines", nargs="+", choices=PIPELINES, default=list(PIPELINES))
+    parser.add_argument("--seed", type=int, default=2021)
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "koodoo_benchmarks"),
+                        help="where the synthetic csv files and databases are kept between runs")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="previous results json to compare with")
+    parser.add_argument("--startup", action="store_true",
+                        help="also time the module imports and cli startup in fresh interpreters")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "results": []
+    }
+
+    for size in args.sizes:
+        for pipeline in args.pipelines:
+            rows = SIZES[size]
+            db = os.path.join(args.workdir, f"wines_{rows}.db")
+            for path in (db, db + "-wal", db + "-shm"):
+                if pipeline == "wines" and os.path.exists(path):
+                    os.remove(path)
+
+            results_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_pipeline,
+                                              args=(pipeline, rows, args.workdir, args.seed, results_queue))
+            process.start()
+            results = collect(process, results_queue, rows)
+            process.join()
+
+            for result in results:
+                result["pipeline"] = pipeline
+                report["results"].append(result)
+                peak = f"{result['peak_rss_mb']:>8.1f} MB" if result["peak_rss_mb"] is not None else f"{'-':>11}"
+                print(f"{pipeline:8} {rows:>10} {result['stage']:26} {result['seconds']:>9.3f}s {peak}"
+                      + (f"  {result['error']}" if result["error"] else ""))
+
+    if args.startup:
+        db = os.path.join(args.workdir, f"wines_{SIZES[args.sizes[-1]]}.db")
+        for result in bench_startup(db):
+            report["results"].append(result)
+            print(f"{'startup':8} {result['stage']:37} {result['seconds']:>9.3f}s  "
+                  f"imports: {', '.join(result['heavy_modules']) or '-'}"
+                  + (f"  {result['error']}" if result["error"] else ""))
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
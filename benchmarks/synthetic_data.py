@@ -0,0 +1,117 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Seeded synthetic generators with the Wines and Airbnb schemas, the real datasets are not shipped.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Rows generated (and written) at a time, so 10M row files do not need 10M rows in memory
+GENERATOR_CHUNKSIZE = 500000
+
+COUNTRIES = {
+    "US": ["California", "Washington", "Oregon", "New York"],
+    "France": ["Bordeaux", "Burgundy", "Champagne", "Rhône Valley"],
+    "Italy": ["Tuscany", "Piedmont", "Veneto", "Sicily & Sardinia"],
+    "Portugal": ["Douro", "Alentejano", "Vinho Verde"],
+    "Spain": ["Northern Spain", "Catalonia", "Levante"]
+}
+VARIETIES = ["Pinot Noir", "Chardonnay", "Cabernet Sauvignon", "Red Blend", "Bordeaux-style Red Blend", "Riesling",
+             "Sauvignon Blanc", "Syrah", "Rosé", "Merlot", "Nebbiolo", "Zinfandel", "Sangiovese", "Malbec",
+             "Portuguese Red", "Tempranillo"]
+STATES = ["NYC", "LA", "SF", "Chicago", "Seattle", "Boston", "Austin", "New Orleans", "Denver"]
+ROOM_TYPES = ["Entire home/apt", "Private room", "Shared room", "Hotel room"]
+
+
+def wines_frame(rows, rng, offset=0):
+    """
+    Synthetic Wines rows, prices formatted like the source ("$1,250").
+    :param rows:
+    :param rng: numpy Generator
+    :param offset: first row number, keeps titles unique across chunks
+    :return: dataframe
+    """
+    country_names = np.array(list(COUNTRIES))
+    country = country_names[rng.integers(0, len(country_names), rows)]
+    province = np.array([COUNTRIES[c][i % len(COUNTRIES[c])] for c, i in zip(country, rng.integers(0, 4, rows))])
+    county = np.where(rng.random(rows) < 0.3, None,
+                      np.char.add("County ", rng.integers(0, 200, rows).astype(str)))
+    vintage = np.where(rng.random(rows) < 0.05, "N.V.", rng.integers(1990, 2018, rows).astype(str))
+    price = np.round(rng.lognormal(3.3, 0.8, rows)).astype(int)
+    variety = np.array(VARIETIES)[rng.integers(0, len(VARIETIES), rows)]
+    winery = np.char.add("Winery ", rng.integers(0, max(rows // 8, 1), rows).astype(str))
+
+    return pd.DataFrame({
+        "vintage": vintage,
+        "country": country,
+        "county": county,
+        "designation": np.char.add("Reserve ", rng.integers(0, 1000, rows).astype(str)),
+        "points": rng.integers(80, 101, rows),
+        "Price": ["${:,}".format(p) for p in price],
+        "province": province,
+        "title": np.char.add("Wine ", np.arange(offset, offset + rows).astype(str)),
+        "variety": variety,
+        "winery": winery
+    })
+
+
+def airbnb_frame(rows, rng, offset=0):
+    """
+    Synthetic Airbnb listings with the 16 columns of the source, including its missing values and
+    "t"/"f" superhost flags.
+    :param rows:
+    :param rng: numpy Generator
+    :param offset: first listing id
+    :return: dataframe
+    """
+    host_since = pd.Timestamp("2008-08-01") + pd.to_timedelta(rng.integers(0, 4400, rows), unit="D")
+    host_since = pd.Series(host_since.strftime("%Y-%m-%d")).where(rng.random(rows) > 0.001)
+    superhost = pd.Series(np.where(rng.random(rows) < 0.25, "t", "f")).where(rng.random(rows) > 0.001)
+    bedrooms = rng.integers(0, 6, rows).astype(float)
+    state = np.array(STATES)[rng.integers(0, len(STATES), rows)]
+
+    return pd.DataFrame({
+        "id": np.arange(offset, offset + rows),
+        "host_id": rng.integers(1, max(rows // 3, 2), rows),
+        "host_since": host_since,
+        "host_is_superhost": superhost,
+        "State": state,
+        "neighbourhood_group": np.char.add(state, np.char.add(" district ", rng.integers(0, 5, rows).astype(str))),
+        "latitude": rng.uniform(25.0, 48.0, rows),
+        "longitude": rng.uniform(-123.0, -71.0, rows),
+        "room_type": np.array(ROOM_TYPES)[rng.integers(0, len(ROOM_TYPES), rows)],
+        "accommodates": rng.integers(1, 12, rows),
+        "bathrooms": pd.Series(rng.integers(1, 8, rows) / 2).where(rng.random(rows) > 0.01),
+        "bedrooms": pd.Series(bedrooms).where(rng.random(rows) > 0.05),
+        "beds": pd.Series(bedrooms + rng.integers(0, 3, rows)).where(rng.random(rows) > 0.01),
+        "price": np.round(rng.lognormal(4.8, 0.7, rows)),
+        "number_of_reviews": rng.poisson(25, rows),
+        "reviews_per_month": pd.Series(rng.gamma(1.5, 1.0, rows).round(2)).where(rng.random(rows) > 0.2)
+    })
+
+
+def write_csv(generator, path, rows, seed=2021):
+    """
+    Write a synthetic dataset to csv, chunk by chunk.
+    :param generator: wines_frame or airbnb_frame
+    :param path:
+    :param rows:
+    :param seed:
+    :return: path
+    """
+    rng = np.random.default_rng(seed)
+    for offset in range(0, rows, GENERATOR_CHUNKSIZE):
+        chunk = generator(min(GENERATOR_CHUNKSIZE, rows - offset), rng, offset)
+        chunk.to_csv(path, mode="w" if offset == 0 else "a", header=offset == 0, index=False)
+    return path
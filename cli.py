@@ -0,0 +1,175 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Command line entry point of both challenges:
+
+    python cli.py wines load --csv Wines.csv --db Wine.db
+    python cli.py wines stats --db Wine.db --group-by country
+    python cli.py airbnb profile --csv airbnb_dataset.csv
+    python cli.py airbnb plot --csv airbnb_dataset.csv --output-dir report
+
+Only the standard library is imported here, each subcommand imports its pipeline when it runs, and the
+pipelines import pandas and the plotting libraries on first use: "wines stats" never imports pandas and
+"airbnb profile" never imports matplotlib.
+"""
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def wines_module():
+    sys.path.insert(0, os.path.join(ROOT, "data-engineering"))
+    import wines_dataset_jcps
+    return wines_dataset_jcps
+
+
+def airbnb_module():
+    sys.path.insert(0, os.path.join(ROOT, "data-science"))
+    import airbnb_dataset_jcps
+    return airbnb_dataset_jcps
+
+
+def wines_load(args):
+    """
+    Load the wines csv into staging_wines and refresh the star schema (incremental, can be run again
+    with new files).
+    """
+    wines = wines_module()
+    chunksize = args.chunksize or (wines.DEFAULT_CHUNKSIZE if args.bulk else None)
+    dataset = wines.WinesDataset(args.csv, chunksize=chunksize, cache_dir=args.cache_dir)
+    dataset.create_db_connection(args.db)
+
+    for table in [wines.sql_create_staging_wines_table] + wines.STAR_SCHEMA_TABLES:
+        dataset.create_db_table(table)
+    dataset.create_indexes()
+
+    if chunksize is None:
+        # Cleans the data in memory before it is loaded, streamed chunks are cleaned as they are read
+        dataset.get_csv_data_types()
+    if args.bulk:
+        dataset.bulk_load_csv_into_table("staging_wines", chunksize)
+    else:
+        dataset.load_csv_into_table("staging_wines")
+    dataset.refresh_star_schema()
+    dataset.close_db_connection()
+
+
+def wines_stats(args):
+    """
+    Row count and price statistics of an existing database, answered from the summary tables when they
+    are up to date.
+    """
+    if not os.path.exists(args.db):
+        sys.exit(f"Database not found: {args.db}")
+
+    wines = wines_module()
+    dataset = wines.WinesDataset(None)
+    dataset.create_db_connection(args.db, readers=1)
+    total = dataset.count_total_table_rows_sw()
+    if total is None:
+        dataset.close_db_connection()
+        sys.exit(f"No staging_wines table in {args.db}, run \"wines load\" first")
+    print("Rows in staging_wines =", total[0])
+    dataset.get_price_info()
+
+    stats = dataset.get_price_stats(args.group_by)
+    for row in stats if args.group_by else [stats]:
+        print(row)
+    if args.percentiles:
+        for row in dataset.get_price_percentiles(args.percentiles, args.group_by):
+            print(row)
+    dataset.close_db_connection()
+
+
+def airbnb_profile(args):
+    """
+    Shape, types, cleaning and the main statistics of the airbnb csv, in memory or chunk by chunk.
+    """
+    airbnb = airbnb_module()
+    airbnb.set_display_options()
+
+    if args.chunksize:
+        dataset = airbnb.ChunkedAirbnbDataset(args.csv, args.chunksize, clean=True)
+        print(dataset.get_dataset_shape())
+        print(dataset.get_null_counts())
+        print("Max price =", dataset.get_max_value("price"))
+        print(airbnb.top_correlation_pairs(dataset.get_correlation(), args.top))
+        return
+
+    dataset = airbnb.AirbnbDataset(args.csv, cache_dir=args.cache_dir)
+    print(dataset.get_dataset_shape())
+    dataset.get_types()
+    dataset.clean_dataset()
+    print("Max price =", dataset.get_max_value("price"))
+    print(dataset.get_top_correlations(args.top))
+
+
+def airbnb_plot(args):
+    """
+    Render the report figures headless to files.
+    """
+    airbnb = airbnb_module()
+    dataset = airbnb.AirbnbDataset(args.csv, cache_dir=args.cache_dir)
+    dataset.clean_dataset()
+    files = dataset.render_report(args.output_dir, args.formats, args.workers)
+    for name, paths in files.items():
+        print(name, " ".join(paths))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    pipelines = parser.add_subparsers(dest="pipeline", required=True)
+
+    wines = pipelines.add_parser("wines", help="wines ETL").add_subparsers(dest="command", required=True)
+    load = wines.add_parser("load", help="load a csv into the database and refresh the star schema")
+    load.add_argument("--csv", default="Wines.csv")
+    load.add_argument("--db", default="Wine.db")
+    load.add_argument("--chunksize", type=int, help="stream the csv in chunks of this many rows")
+    load.add_argument("--bulk", action="store_true", help="bulk load path (relaxed pragmas, executemany)")
+    load.add_argument("--cache-dir", help="cache of the parsed csv")
+    load.set_defaults(func=wines_load)
+
+    stats = wines.add_parser("stats", help="row count and price statistics")
+    stats.add_argument("--db", default="Wine.db")
+    stats.add_argument("--group-by", choices=["variety", "country", "winery", "vintage"])
+    stats.add_argument("--percentiles", type=float, nargs="+", help="e.g. 0.25 0.5 0.75")
+    stats.set_defaults(func=wines_stats)
+
+    airbnb = pipelines.add_parser("airbnb", help="airbnb analysis").add_subparsers(dest="command", required=True)
+    profile = airbnb.add_parser("profile", help="types, cleaning and main statistics")
+    profile.add_argument("--csv", default="airbnb_dataset.csv")
+    profile.add_argument("--chunksize", type=int, help="out-of-core, chunks of this many rows")
+    profile.add_argument("--top", type=int, default=10, help="number of correlated pairs shown")
+    profile.add_argument("--cache-dir", help="cache of the parsed csv")
+    profile.set_defaults(func=airbnb_profile)
+
+    plot = airbnb.add_parser("plot", help="render the report figures to files")
+    plot.add_argument("--csv", default="airbnb_dataset.csv")
+    plot.add_argument("--output-dir", default="report")
+    plot.add_argument("--formats", nargs="+", default=["png"])
+    plot.add_argument("--workers", type=int)
+    plot.add_argument("--cache-dir", help="cache of the parsed csv")
+    plot.set_defaults(func=airbnb_plot)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+SQLite connection manager: one writer and a pool of read-only connections over a WAL database,
+so readers run alongside each other and alongside a load.
+"""
+
+import contextlib
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+
+
+class ConnectionManager:
+    """
+    The writer is opened at once and switches the database to WAL, every write goes through write(), which
+    gives it to one thread at a time. Readers are opened lazily with a mode=ro URI, at most `readers` of
+    them. A thread keeps the same reader for the whole outermost read() block (nested blocks and generators
+    inside it share it), then gives it back to the pool.
+    With an in-memory database, or readers=0, reads go through the writer.
+    """
+
+    def __init__(self, db_name, readers=4, busy_timeout=5.0, retries=5, retry_delay=0.05):
+        """
+        :param db_name: database file
+        :param readers: maximum number of read-only connections
+        :param busy_timeout: seconds a statement waits on a locked database before failing
+        :param retries: extra attempts of an operation still failing with "database is locked"
+        :param retry_delay: first wait between attempts, doubled every time
+        """
+        self.db_name = db_name
+        self.busy_timeout = busy_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.readers = 0 if db_name == ":memory:" else readers
+
+        self.writer = sqlite3.connect(db_name, timeout=busy_timeout, check_same_thread=False)
+        if self.readers:
+            self.writer.execute("PRAGMA journal_mode=WAL")
+        self.write_lock = threading.RLock()
+
+        self.idle = queue.LifoQueue()
+        self.opened = []
+        self.open_lock = threading.Lock()
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect_reader(self):
+        uri = pathlib.Path(self.db_name).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=self.busy_timeout, check_same_thread=False)
+        self.opened.append(conn)
+        return conn
+
+    def acquire(self):
+        """
+        An idle reader, a new one while below the limit, or wait for one to be released.
+        :return: connection
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.open_lock:
+            if len(self.opened) < self.readers:
+                return self.connect_reader()
+        return self.idle.get()
+
+    @contextlib.contextmanager
+    def read(self):
+        """
+        Read-only connection bound to the current thread for the duration of the block.
+        :return: context manager yielding a connection
+        """
+        if not self.readers:
+            with self.write_lock:
+                yield self.writer
+            return
+
+        # Blocks of the thread holding its reader, it goes back to the pool when the outermost one exits
+        depth = getattr(self.local, "depth", 0)
+        if not depth:
+            self.local.conn = self.acquire()
+        self.local.depth = depth + 1
+        try:
+            yield self.local.conn
+        finally:
+            self.local.depth -= 1
+            if not self.local.depth:
+                conn, self.local.conn = self.local.conn, None
+                self.idle.put(conn)
+
+    @contextlib.contextmanager
+    def write(self):
+        """
+        The writer, held by one thread at a time, in a transaction committed at the end of the block
+        (rolled back on error).
+        :return: context manager yielding the connection
+        """
+        with self.write_lock:
+            with self.writer:
+                yield self.writer
+
+    def retry(self, function, *args, **kwargs):
+        """
+        Call function, again with exponential backoff while SQLite reports the database as locked or busy.
+        :param function:
+        :return: function result
+        """
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                message = str(e)
+                if attempt == self.retries or ("locked" not in message and "busy" not in message):
+                    raise
+            time.sleep(delay)
+            delay *= 2
+
+    def close(self):
+        """
+        Close the readers and the writer (once no thread is writing).
+        :return:
+        """
+        with self.open_lock:
+            for conn in self.opened:
+                conn.close()
+            self.opened = []
+            self.idle = queue.LifoQueue()
+        with self.write_lock:
+            self.writer.close()
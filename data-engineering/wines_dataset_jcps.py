@@ -17,44 +17,540 @@ jcps@ua.pt
 Data Engineering Challenge for Data Intern Position at Koodoo.
 """
 
-import pandas as pd
-import sqlite3
+import contextlib
+import csv
+import functools
+import inspect
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
 
+from collections import OrderedDict, namedtuple
+from queue import Empty, Queue
 from sqlite3 import Error
 
+# Shared modules live at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
 
+from connection_manager import ConnectionManager
+from frame_cache import FrameCache
+from instrumentation import instrument_public_methods
+from lazy_import import lazy_import
+
+# pandas is only imported by the commands that read csv files, the SQL queries do not need it
+pd = lazy_import("pandas")
+
+# Rows read per chunk when streaming the csv
+DEFAULT_CHUNKSIZE = 100000
+
+# Seconds the multi-file writer waits for a batch before checking that the parse workers are alive
+WORKER_POLL_SECONDS = 1.0
+
+# Relaxed durability settings, only used during the bulk load window
+BULK_LOAD_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    "cache_size": -262144,
+    "temp_store": "MEMORY"
+}
+
+# Unique natural keys of the dimensions, the incremental refresh upserts against them (NULL-safe)
+DIM_NATURAL_KEYS = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_dimwinery_winery_name ON dimwinery (IFNULL(winery_name, ''))",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_dimvariety_variety ON dimvariety (IFNULL(variety, ''))",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_dimgeography_location "
+    "ON dimgeography (IFNULL(country, ''), IFNULL(province, ''), IFNULL(county, ''))"
+]
+
+# Secondary indexes: natural keys used by the joins and foreign keys of factwine.
+# Not constraints, so they can be dropped during bulk loads and rebuilt afterwards.
+SECONDARY_INDEXES = {
+    "ix_staging_wines_winery": ("staging_wines", "winery"),
+    "ix_staging_wines_variety": ("staging_wines", "variety"),
+    "ix_staging_wines_geography": ("staging_wines", "country, province, county"),
+    "ix_dimwinery_winery_name": ("dimwinery", "winery_name"),
+    "ix_dimvariety_variety": ("dimvariety", "variety"),
+    "ix_dimgeography_location": ("dimgeography", "country, province, county"),
+    "ix_factwine_winery_id": ("factwine", "winery_id"),
+    "ix_factwine_geography_id": ("factwine", "geography_id"),
+    "ix_factwine_variety_id": ("factwine", "variety_id"),
+    "ix_factwine_price": ("factwine", "price")
+}
+
+# Group-by dimensions of the analytics queries: join clause and grouping column
+GROUP_BY_DIMENSIONS = {
+    "variety": ("JOIN dimvariety d ON f.variety_id = d.variety_id", "d.variety"),
+    "country": ("JOIN dimgeography d ON f.geography_id = d.geography_id", "d.country"),
+    "winery": ("JOIN dimwinery d ON f.winery_id = d.winery_id", "d.winery_name"),
+    "vintage": ("", "f.vintage")
+}
+
+# Materialized aggregates: summary table -> (source table, id column, group-by dimension or None for the total).
+# Each one is kept up to date from a high-water mark on the id column of its source, and rebuilt when rows of
+# its source or dimension were deleted or updated (see refresh_summary_tables).
+SUMMARY_TABLES = {
+    "summary_staging_wines": ("staging_wines", "rowid", None),
+    "summary_factwine": ("factwine", "wine_id", None),
+    "summary_factwine_variety": ("factwine", "wine_id", "variety"),
+    "summary_factwine_country": ("factwine", "wine_id", "country"),
+    "summary_factwine_winery": ("factwine", "wine_id", "winery"),
+    "summary_factwine_vintage": ("factwine", "wine_id", "vintage")
+}
+
+PriceStats = namedtuple("PriceStats", ["group", "count", "avg", "min", "max"])
+PricePercentile = namedtuple("PricePercentile", ["group", "percentile", "price"])
+WineSummary = namedtuple("WineSummary", ["group", "rows", "price_count", "price_sum", "price_min", "price_max",
+                                         "points_count", "points_sum", "points_min", "points_max"])
+
+# staging_wines table creation with correct data types.
+# staging_id never hands out a value twice, even once the table is emptied (AUTOINCREMENT), so the rows
+# above the star schema high-water mark are always the ones loaded since the last refresh.
+sql_create_staging_wines_table = """ CREATE TABLE IF NOT EXISTS staging_wines (
+vintage TEXT,
+country TEXT,
+county TEXT,
+designation TEXT,
+points INTEGER,
+price REAL,
+province TEXT,
+title TEXT,
+variety TEXT,
+winery TEXT,
+staging_id INTEGER PRIMARY KEY AUTOINCREMENT);
+"""
+
+sql_create_dim_winery_table = """CREATE TABLE IF NOT EXISTS dimwinery (
+winery_id INTEGER PRIMARY KEY,
+winery_name TEXT)
+"""
+
+sql_create_dim_geography_table = """CREATE TABLE IF NOT EXISTS dimgeography (
+geography_id INTEGER PRIMARY KEY,
+country TEXT,
+province TEXT,
+county TEXT)
+"""
+
+sql_create_dim_variety_table = """CREATE TABLE IF NOT EXISTS dimvariety (
+variety_id INTEGER PRIMARY KEY,
+variety TEXT)
+"""
+
+# MANY - TO - ONE relationships, one wine have one winery but one winery can have many wines
+sql_create_fact_wine_table = """CREATE TABLE IF NOT EXISTS factwine (
+wine_id INTEGER PRIMARY KEY,
+title TEXT,
+winery_id INTEGER,
+geography_id INTEGER,
+variety_id INTEGER,
+points INTEGER,
+price REAL,
+vintage TEXT,
+FOREIGN KEY (winery_id) REFERENCES dimwinery (winery_id),
+FOREIGN KEY (geography_id) REFERENCES dimgeography (geography_id),
+FOREIGN KEY (variety_id) REFERENCES dimvariety (variety_id)
+)
+"""
+
+# Tables of the star schema, dimensions first
+STAR_SCHEMA_TABLES = [sql_create_dim_winery_table, sql_create_dim_geography_table, sql_create_dim_variety_table,
+                      sql_create_fact_wine_table]
+
+# Last staging rowid already propagated to the star schema
+sql_create_etl_watermark_table = """CREATE TABLE IF NOT EXISTS etl_watermark (
+source TEXT PRIMARY KEY,
+last_rowid INTEGER)
+"""
+
+# Deletes and updates of each table a summary depends on, counted by triggers
+sql_create_etl_changes_table = """CREATE TABLE IF NOT EXISTS etl_changes (
+source TEXT PRIMARY KEY,
+changes INTEGER NOT NULL DEFAULT 0)
+"""
+
+# Changes of its sources already seen by each summary table when it was last refreshed
+sql_create_etl_summary_changes_table = """CREATE TABLE IF NOT EXISTS etl_summary_changes (
+summary TEXT PRIMARY KEY,
+changes INTEGER)
+"""
+
+sql_create_change_trigger = """CREATE TRIGGER IF NOT EXISTS {source}_{event}_changes AFTER {event} ON {source}
+BEGIN
+UPDATE etl_changes SET changes = changes + 1 WHERE source = '{source}';
+END
+"""
+
+# Aggregates of price and points per group (grp is NULL for the totals), unique on the NULL-safe group
+sql_create_summary_table = """CREATE TABLE IF NOT EXISTS {table} (
+grp,
+rows INTEGER,
+price_count INTEGER,
+price_sum REAL,
+price_min,
+price_max,
+points_count INTEGER,
+points_sum REAL,
+points_min,
+points_max)
+"""
+
+
+# Target dtype of each wines column (matched case-insensitively), used by clean_wines_frame.
+# Integer columns fall back to the nullable type when values are missing or rejected.
+# float32 is an in-memory type only, sql_frame widens it before anything is written to SQLite.
+WINES_SCHEMA = {
+    "vintage": "Int16",
+    "country": "category",
+    "county": "category",
+    "designation": "string",
+    "points": "int16",
+    "price": "float32",
+    "province": "category",
+    "title": "string",
+    "variety": "category",
+    "winery": "category"
+}
+
+# Columns holding amounts like "$1,200"
+CURRENCY_COLUMNS = {"price"}
+
+
+def clean_wines_frame(frame, schema=WINES_SCHEMA):
+    """
+    Declarative cleaning of a wines dataframe (or chunk), in place, with one vectorized pass per column:
+    currency symbols and separators stripped, numeric coercion and compact dtypes from the schema.
+    :param frame:
+    :param schema: dict column -> dtype
+    :return: dict column -> number of values rejected (set to missing) by the numeric coercion
+    """
+    rejected = {}
+    for column in frame.columns:
+        dtype = schema.get(column.lower())
+        if dtype is None:
+            continue
+
+        values = frame[column]
+        if dtype in ("category", "string"):
+            frame[column] = values.astype(dtype)
+            continue
+
+        if not pd.api.types.is_numeric_dtype(values):
+            if column.lower() in CURRENCY_COLUMNS:
+                values = values.str.replace(r"[$,]", "", regex=True)
+            numbers = pd.to_numeric(values, errors='coerce')
+            rejected[column] = int((numbers.isna() & values.notna()).sum())
+        else:
+            numbers = values
+
+        if dtype.startswith("int") and numbers.isna().any():
+            dtype = dtype.capitalize()
+        frame[column] = numbers.astype(dtype)
+    return rejected
+
+
+def sql_frame(frame):
+    """
+    The dataframe as it should be written to SQLite: float32 columns are only compact in memory, they are
+    widened to float64 (currency rounded to cents) so 15.99 is stored as 15.99 and not 15.989999771118164.
+    :param frame:
+    :return: dataframe, frame itself when there is nothing to widen
+    """
+    widened = {}
+    for column in frame.columns:
+        if frame[column].dtype == "float32":
+            values = frame[column].astype("float64")
+            widened[column] = values.round(2) if column.lower() in CURRENCY_COLUMNS else values
+    return frame.assign(**widened) if widened else frame
+
+
+def frame_records(frame):
+    """
+    Rows of a dataframe as tuples of python values, NaN mapped to NULL, ready for executemany.
+    :param frame:
+    :return: list of tuples
+    """
+    frame = sql_frame(frame)
+    columns = [frame[column].astype(object).where(frame[column].notna(), None).tolist() for column in frame.columns]
+    return list(zip(*columns))
+
+
+def arrow_type(declared_type):
+    """
+    Arrow type of a SQLite column from its declared type, following the SQLite type affinity rules
+    (columns without a declared type are exported as strings).
+    :param declared_type: e.g. "TEXT", "REAL", "INTEGER"
+    :return: "int64", "float64" or "string"
+    """
+    declared_type = (declared_type or "").upper()
+    if "INT" in declared_type:
+        return "int64"
+    if any(name in declared_type for name in ("CHAR", "CLOB", "TEXT")):
+        return "string"
+    if any(name in declared_type for name in ("REAL", "FLOA", "DOUB")):
+        return "float64"
+    return "string"
+
+
+def summary_sources(table):
+    """
+    Tables whose deletes and updates make a summary stale: its source and the dimension it is grouped by.
+    :param table: summary table
+    :return: list of table names
+    """
+    source, _, group_by = SUMMARY_TABLES[table]
+    join = GROUP_BY_DIMENSIONS[group_by][0] if group_by is not None else ""
+    return [source] + ([join.split()[1]] if join else [])
+
+
+def tracked_sources(c):
+    """
+    Tables that have their change triggers, i.e. whose deletes and updates are all counted in etl_changes.
+    :param c: cursor or connection
+    :return: set of table names
+    """
+    triggers = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    return {name[:-len("_delete_changes")] for name in triggers if name.endswith("_delete_changes")
+            and name.replace("_delete_", "_update_") in triggers}
+
+
+def summary_price_stats(summary):
+    """
+    PriceStats of a WineSummary, like the SQL aggregates (avg is None without prices).
+    :param summary: WineSummary, None for an empty source
+    :return: PriceStats
+    """
+    if summary is None:
+        return PriceStats(None, 0, None, None, None)
+    avg = summary.price_sum / summary.price_count if summary.price_count else None
+    return PriceStats(summary.group, summary.price_count, avg, summary.price_min, summary.price_max)
+
+
+def _parse_csv_file(file, chunksize, batches):
+    """
+    Parse and clean one csv chunk by chunk, putting (file, columns, records, seconds) batches on the
+    batches queue. A batch with no columns marks the end of the file (error holds the failure, if any).
+    :param file:
+    :param chunksize:
+    :param batches: bounded queue feeding the writer
+    :return:
+    """
+    error = None
+    try:
+        start = time.perf_counter()
+        for chunk in pd.read_csv(file, chunksize=chunksize):
+            clean_wines_frame(chunk)
+            records = frame_records(chunk)
+            batches.put((file, list(chunk.columns), records, time.perf_counter() - start))
+            start = time.perf_counter()
+    except Exception as e:
+        error = f"{file}: {e}"
+    batches.put((file, None, error, 0))
+
+
+def _parse_worker(files, batches, chunksize):
+    """
+    Worker process: parse the files taken from the files queue until it yields None.
+    :param files: queue of csv files
+    :param batches:
+    :param chunksize:
+    :return:
+    """
+    for file in iter(files.get, None):
+        _parse_csv_file(file, chunksize, batches)
+
+
+def _relay_batches(batches, relay):
+    """
+    Thread of the writer process moving batches from the worker queue to a local queue. A worker killed
+    halfway through sending a batch leaves a partial message that blocks its reader for good, this
+    thread takes that block so the writer can still time out and notice the dead worker.
+    :param batches: multiprocessing queue filled by the workers
+    :param relay: local queue read by the writer, None once the workers are done
+    :return:
+    """
+    for batch in iter(batches.get, None):
+        relay.put(batch)
+
+
+def holds_writer(method):
+    """
+    Run a WinesDataset method holding the single writer connection (ConnectionManager.write), so the
+    methods of two threads writing at once run one after the other instead of mixing their transactions.
+    The writer lock is reentrant, a method can call other writing methods.
+    :param method:
+    :return: wrapped method
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.connections is None:
+            return method(self, *args, **kwargs)
+        with self.connections.write():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class DimensionKeyCache:
+    """
+    Natural key -> surrogate key lookup for one dimension table, loaded once into a hash map.
+    With a maxsize the least recently used keys are evicted and misses go back to the database.
+    Members not found in the dimension are inserted and their new surrogate key is cached.
+    """
+
+    def __init__(self, conn, table, key_column, natural_columns, maxsize=None):
+        self.conn = conn
+        self.table = table
+        self.key_column = key_column
+        self.natural_columns = natural_columns
+        self.maxsize = maxsize
+        self.keys = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        """
+        Load the dimension in one scan (up to maxsize keys).
+        :return:
+        """
+        self.keys.clear()
+        c = self.conn.execute(f"SELECT {', '.join(self.natural_columns)}, {self.key_column} FROM {self.table}")
+        for row in c:
+            if self.maxsize is not None and len(self.keys) >= self.maxsize:
+                break
+            self.keys[row[:-1]] = row[-1]
+
+    def get(self, natural_key):
+        """
+        Surrogate key of a dimension member, inserting the member if it is new.
+        :param natural_key: tuple with the natural column values
+        :return: surrogate key
+        """
+        key = self.keys.get(natural_key)
+        if key is not None:
+            self.hits += 1
+            if self.maxsize is not None:
+                self.keys.move_to_end(natural_key)
+            return key
+
+        self.misses += 1
+        where = " AND ".join(f"{column} IS ?" for column in self.natural_columns)
+        row = self.conn.execute(f"SELECT {self.key_column} FROM {self.table} WHERE {where}", natural_key).fetchone()
+        if row is not None:
+            key = row[0]
+        else:
+            columns = ", ".join(self.natural_columns)
+            values = ", ".join("?" * len(self.natural_columns))
+            key = self.conn.execute(f"INSERT INTO {self.table} ({columns}) VALUES ({values})", natural_key).lastrowid
+
+        self.keys[natural_key] = key
+        if self.maxsize is not None and len(self.keys) > self.maxsize:
+            self.keys.popitem(last=False)
+        return key
+
+
+@instrument_public_methods
 class WinesDataset:
-    def __init__(self, file):
-        self.data = pd.read_csv(file)
+    def __init__(self, file, chunksize=None, instrumentation=None, cache_dir=None):
+        """
+        :param file: wines csv, None to only query an existing database
+        :param chunksize: if given, the csv is never fully read into memory, it is streamed chunk by chunk at load time
+        :param instrumentation: Instrumentation recording every public method as a stage
+        :param cache_dir: if given, the parsed and cleaned csv is cached there (see FrameCache)
+        """
+        self.file = file
+        self.chunksize = chunksize
+        self.instrumentation = instrumentation
+        self.cache = FrameCache(cache_dir) if cache_dir is not None else None
+        # Values rejected by the cleaning of the in-memory frame, or of the last streaming pass over the csv
+        self.rejected = {}
         self.conn = None
+        self.connections = None
+        self.data = self.read_csv() if chunksize is None and file is not None else None
+
+    def read_csv(self):
+        """
+        Read the whole csv. With a cache, the frame is parsed and cleaned once and then memory-mapped
+        from the cache until the csv or the cleaning rules change.
+        The values rejected by the cleaning are cached with the frame (in its attrs), so they are still
+        reported on a cache hit.
+        :return: dataframe
+        """
+        self.rejected = {}
+        if self.cache is None:
+            return pd.read_csv(self.file)
+
+        def parse():
+            data = pd.read_csv(self.file)
+            data.attrs["rejected"] = clean_wines_frame(data)
+            return data
 
-    def create_db_connection(self, db_name):
+        rules = repr(WINES_SCHEMA) + repr(CURRENCY_COLUMNS) + inspect.getsource(clean_wines_frame)
+        data = self.cache.get_or_parse(self.file, rules, parse)
+        self.count_rejected(data.attrs.get("rejected", {}))
+        return data
+
+    def create_db_connection(self, db_name, readers=4):
         """
         Create a database connection to a SQLite database.
+        self.conn is the single writer, the read queries use a pool of read-only connections
+        (see ConnectionManager), so they can run from several threads while a load is running.
         :param db_name:
+        :param readers: size of the read-only pool, 0 to read through the writer
         :return:
         """
         self.conn = None
         try:
-            self.conn = sqlite3.connect(db_name)
-            print(sqlite3.version)
+            self.connections = ConnectionManager(db_name, readers)
+            self.conn = self.connections.writer
         except Error as e:
-            print(e)
+            self._report_error(e)
+
+    def _report_error(self, error):
+        """
+        Print a database error handled by a method and record it on the running instrumentation stage,
+        so the stage is not reported as ok.
+        :param error:
+        :return:
+        """
+        print(error)
+        if self.instrumentation is not None:
+            self.instrumentation.record_error(error)
+
+    @contextlib.contextmanager
+    def _reader(self):
+        """
+        Read-only connection of the current thread, watched by the instrumentation if any.
+        :return: context manager yielding a connection
+        """
+        with self.connections.read() as conn:
+            if self.instrumentation is not None:
+                self.instrumentation.watch(conn)
+            yield conn
 
     def get_csv_data_types(self):
         """
         Get Wines data types to table creation.
         Only the variable "points" appears with an int64 datatype, the rest are represented as strings.
+        The data is cleaned to the compact dtypes of WINES_SCHEMA, values that fail the numeric coercion
+        are reported (those of the whole csv when it was cleaned earlier, e.g. loaded from the cache).
+        In streaming mode only the first chunk is inspected.
         :return:
         """
+        data = self.data if self.data is not None else pd.read_csv(self.file, nrows=self.chunksize)
 
-        self.data.Price = self.data['Price'].str.replace("$", "")
-        self.data.Price = self.data['Price'].str.replace(",", "")
-
-        print(pd.to_numeric(self.data['Price'], errors='raise').value_counts())
+        rejected = clean_wines_frame(data)
+        if data is self.data:
+            self.count_rejected(rejected)
+            rejected = self.rejected
+        for column, count in rejected.items():
+            print(f"{column}: {count} values rejected")
 
-        return self.data.dtypes
+        return data.dtypes
 
+    @holds_writer
     def create_db_table(self, table):
         """
         Create table.
@@ -65,16 +561,355 @@ class WinesDataset:
                 c = self.conn.cursor()
                 c.execute(table)
             except Error as e:
-                print(e)
+                self._report_error(e)
         else:
             print("Connection to database refused!")
 
+    @holds_writer
     def load_csv_into_table(self, table_name):
+        """
+        Load the csv into a table, streaming it when a chunksize was given.
+        :param table_name:
+        :return:
+        """
+        if self.chunksize is not None:
+            return self.load_csv_in_chunks(table_name)
+
+        if self.conn is not None:
+            try:
+                sql_frame(self.data).to_sql(table_name, self.conn, if_exists='append', index=False)
+                self.refresh_summary_tables()
+            except Error as e:
+                self._report_error(e)
+        else:
+            print("Connection to database refused!")
+
+    @holds_writer
+    def load_csv_in_chunks(self, table_name, chunksize=None):
+        """
+        Stream the csv into a table. Every chunk is cleaned and loaded in its own transaction,
+        so memory stays bounded by the chunk size and not by the size of the file.
+        :param table_name:
+        :param chunksize: rows per chunk, defaults to the one given at creation
+        :return: number of rows loaded
+        """
         if self.conn is not None:
+            chunksize = chunksize or self.chunksize or DEFAULT_CHUNKSIZE
+            loaded = 0
+            start = time.perf_counter()
             try:
-                self.data.to_sql(table_name, self.conn, if_exists='append', index=False)
+                for chunk in self.iter_clean_chunks(chunksize):
+                    with self.conn:
+                        sql_frame(chunk).to_sql(table_name, self.conn, if_exists='append', index=False)
+                    loaded += len(chunk)
+                    elapsed = time.perf_counter() - start
+                    print(f"{loaded} rows loaded ({loaded / elapsed:.0f} rows/sec)")
+                self.refresh_summary_tables()
             except Error as e:
-                print(e)
+                self._report_error(e)
+            print(f"Values rejected by the cleaning: {self.rejected}")
+            return loaded
+        else:
+            print("Connection to database refused!")
+
+    @holds_writer
+    def ingest_files(self, files, table_name, workers=None, chunksize=DEFAULT_CHUNKSIZE, queue_size=8):
+        """
+        Load many wines csv shards. Parsing and cleaning run in worker processes, the cleaned batches go
+        through a bounded queue to this connection, the single SQLite writer, with bulk load pragmas.
+        A worker that dies without finishing its files (killed by a signal or the OOM killer) stops the
+        ingest instead of leaving the writer waiting, the batches already written stay committed. A file
+        that fails (malformed line, worker died) is reported with the rows of it that were committed.
+        :param files: list of csv files
+        :param table_name:
+        :param workers: worker processes, cpu count by default
+        :param chunksize: rows per batch
+        :param queue_size: max batches waiting for the writer
+        :return: dict with rows loaded, per stage seconds (parse is summed over the workers) and the files
+        that did not load completely ("failed", file -> rows of it committed)
+        """
+        if self.conn is not None:
+            timings = {"rows": 0, "parse": 0.0, "queue_wait": 0.0, "write": 0.0, "total": 0.0, "failed": {}}
+            start = time.perf_counter()
+            previous = None
+            pending = set(files)
+            committed = dict.fromkeys(files, 0)
+            tasks = multiprocessing.Queue()
+            batches = multiprocessing.Queue(queue_size)
+            processes = [multiprocessing.Process(target=_parse_worker, args=(tasks, batches, chunksize), daemon=True)
+                         for _ in range(max(1, min(workers or os.cpu_count(), len(files))))]
+            try:
+                for file in files:
+                    tasks.put(file)
+                for process in processes:
+                    tasks.put(None)
+                    process.start()
+
+                self.conn.commit()
+                previous = self.set_pragmas(BULK_LOAD_PRAGMAS)
+                relay = Queue(1)
+                threading.Thread(target=_relay_batches, args=(batches, relay), daemon=True).start()
+                while pending:
+                    wait = time.perf_counter()
+                    try:
+                        file, columns, records, parse_time = relay.get(timeout=WORKER_POLL_SECONDS)
+                    except Empty:
+                        timings["queue_wait"] += time.perf_counter() - wait
+                        # A worker that exits puts all its batches first, so with nothing queued after the
+                        # timeout, a failed worker or all workers gone means the pending files are lost
+                        dead = [process.exitcode for process in processes if process.exitcode not in (None, 0)]
+                        if dead or all(process.exitcode == 0 for process in processes):
+                            print(f"Parse worker died (exit codes {dead}), files not loaded: {sorted(pending)}")
+                            break
+                        continue
+                    timings["queue_wait"] += time.perf_counter() - wait
+                    if columns is None:
+                        pending.discard(file)
+                        if records is not None:
+                            print(f"{records} ({committed[file]} rows of the file committed)")
+                            timings["failed"][file] = committed[file]
+                        continue
+
+                    write = time.perf_counter()
+                    insert = "INSERT INTO {} ({}) VALUES ({})".format(
+                        table_name, ",".join(columns), ",".join("?" * len(columns)))
+                    with self.conn:
+                        self.conn.executemany(insert, records)
+                    timings["write"] += time.perf_counter() - write
+                    timings["parse"] += parse_time
+                    timings["rows"] += len(records)
+                    committed[file] += len(records)
+                self.refresh_summary_tables()
+            except Error as e:
+                self._report_error(e)
+            finally:
+                for process in processes:
+                    if process.is_alive():
+                        process.terminate()
+                    if process.pid is not None:
+                        process.join()
+                # Stops the relay thread, unless it is stuck on a batch cut short by a dead worker
+                batches.put(None)
+                if previous is not None:
+                    self.set_pragmas(previous)
+
+            timings["failed"].update((file, committed[file]) for file in pending)
+            timings["total"] = time.perf_counter() - start
+            if timings["failed"]:
+                print(f"Files not loaded completely (rows committed): {timings['failed']}")
+            print(f"{timings['rows']} rows from {len(files) - len(timings['failed'])} complete files "
+                  f"in {timings['total']:.2f}s "
+                  f"(parse {timings['parse']:.2f}s, writer waiting {timings['queue_wait']:.2f}s, "
+                  f"write {timings['write']:.2f}s)")
+            return timings
+        else:
+            print("Connection to database refused!")
+
+    def iter_clean_chunks(self, chunksize):
+        """
+        Iterate over the wines data in cleaned chunks, read from the csv in streaming mode.
+        Every streaming pass counts the rejected values again from zero, the in-memory frame is only
+        cleaned (and counted) once.
+        :param chunksize:
+        :return: generator of dataframes
+        """
+        if self.data is None:
+            self.rejected = {}
+            for chunk in pd.read_csv(self.file, chunksize=chunksize):
+                self.count_rejected(clean_wines_frame(chunk))
+                yield chunk
+        else:
+            self.count_rejected(clean_wines_frame(self.data))
+            for start in range(0, len(self.data), chunksize):
+                yield self.data.iloc[start:start + chunksize]
+
+    def count_rejected(self, rejected):
+        """
+        Accumulate the values rejected by the cleaning, per column, within the current pass.
+        :param rejected: dict column -> count
+        :return:
+        """
+        for column, count in rejected.items():
+            self.rejected[column] = self.rejected.get(column, 0) + count
+
+    @holds_writer
+    def set_pragmas(self, pragmas):
+        """
+        Apply SQLite pragmas to the connection.
+        :param pragmas: dict name -> value
+        :return: dict with the previous values, to restore them later
+        """
+        c = self.conn.cursor()
+        previous = {name: c.execute(f"PRAGMA {name}").fetchone()[0] for name in pragmas}
+        for name, value in pragmas.items():
+            c.execute(f"PRAGMA {name} = {value}")
+        return previous
+
+    @holds_writer
+    def bulk_load_csv_into_table(self, table_name, batch_size=DEFAULT_CHUNKSIZE, defer_indexes=True):
+        """
+        Bulk load of the csv. The durability pragmas are relaxed for the load window and rows are
+        inserted with executemany over one prepared statement, one transaction per batch.
+        The previous (safe) pragmas are restored afterwards, even on error.
+        to_sql also inserts through executemany, so the gain comes from the deferred index builds (about 1.6x
+        on 300k rows with the staging indexes) and from skipping fsync, none without indexes on a fast disk.
+        :param table_name:
+        :param batch_size: rows per transaction
+        :param defer_indexes: drop the secondary indexes of the table during the load and rebuild them after
+        :return: elapsed seconds
+        """
+        if self.conn is not None:
+            loaded = 0
+            previous = None
+            dropped = []
+            start = time.perf_counter()
+            try:
+                self.conn.commit()
+                if defer_indexes:
+                    dropped = self.drop_secondary_indexes(table_name)
+                previous = self.set_pragmas(BULK_LOAD_PRAGMAS)
+                for chunk in self.iter_clean_chunks(batch_size):
+                    insert = "INSERT INTO {} ({}) VALUES ({})".format(
+                        table_name, ",".join(chunk.columns), ",".join("?" * len(chunk.columns)))
+                    with self.conn:
+                        self.conn.executemany(insert, frame_records(chunk))
+                    loaded += len(chunk)
+            except Error as e:
+                self._report_error(e)
+            finally:
+                if previous is not None:
+                    self.set_pragmas(previous)
+                if dropped:
+                    self.create_indexes(dropped)
+            # Same post-load work as the to_sql paths, counted in the elapsed time
+            self.refresh_summary_tables()
+            elapsed = time.perf_counter() - start
+            print(f"{loaded} rows bulk loaded in {elapsed:.2f}s ({loaded / max(elapsed, 1e-9):.0f} rows/sec)")
+            return elapsed
+        else:
+            print("Connection to database refused!")
+
+    @holds_writer
+    def create_indexes(self, names=None):
+        """
+        Create the secondary indexes (all by default) of the tables that exist, then refresh planner statistics.
+        :param names: index names from SECONDARY_INDEXES
+        :return: list of index names created
+        """
+        if self.conn is not None:
+            created = []
+            try:
+                c = self.conn.cursor()
+                tables = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                for name in names or SECONDARY_INDEXES:
+                    table, columns = SECONDARY_INDEXES[name]
+                    if table in tables:
+                        c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+                        created.append(name)
+                c.execute("ANALYZE")
+                self.conn.commit()
+            except Error as e:
+                self._report_error(e)
+            return created
+        else:
+            print("Connection to database refused!")
+
+    @holds_writer
+    def drop_secondary_indexes(self, table_name=None):
+        """
+        Drop the existing secondary indexes (of one table, or all) before a bulk load.
+        Unique natural keys are constraints and are never dropped.
+        :param table_name:
+        :return: list of index names dropped, to give back to create_indexes
+        """
+        if self.conn is not None:
+            dropped = []
+            try:
+                c = self.conn.cursor()
+                existing = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+                for name, (table, _) in SECONDARY_INDEXES.items():
+                    if name in existing and table_name in (None, table):
+                        c.execute(f"DROP INDEX {name}")
+                        dropped.append(name)
+                self.conn.commit()
+            except Error as e:
+                self._report_error(e)
+            return dropped
+        else:
+            print("Connection to database refused!")
+
+    def explain_query_plan(self, query, params=()):
+        """
+        EXPLAIN QUERY PLAN of a query, to check the joins use the indexes.
+        :param query:
+        :param params:
+        :return: list of plan steps
+        """
+        if self.conn is not None:
+            try:
+                with self._reader() as conn:
+                    return [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+            except Error as e:
+                self._report_error(e)
+        else:
+            print("Connection to database refused!")
+
+    @holds_writer
+    def compare_load_paths(self, table_name):
+        """
+        Time the to_sql path against the bulk load path, both into scratch copies of table_name with
+        the same secondary indexes, from the same cleaned input and with the same post-load work.
+        Both paths insert through executemany, most of the difference comes from building the indexes
+        once after the load instead of row by row, and from the relaxed pragmas when fsync is slow.
+        Without secondary indexes on table_name, expect a speedup close to 1.
+        :param table_name: table whose schema is copied
+        :return: speedup of the bulk load over to_sql
+        """
+        if self.conn is not None:
+            try:
+                c = self.conn.cursor()
+                indexes = [(name, sql) for name, sql in c.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (table_name,))
+                    if name in SECONDARY_INDEXES]
+                scratch_indexes = {}
+                for scratch in ("compare_to_sql", "compare_bulk"):
+                    c.execute(f"DROP TABLE IF EXISTS {scratch}")
+                    c.execute(f"CREATE TABLE {scratch} AS SELECT * FROM {table_name} WHERE 0")
+                    scratch_indexes[scratch] = [
+                        (f"{scratch}_{name}", f"CREATE INDEX {scratch}_{name} ON {scratch} "
+                                              f"{sql[sql.index('('):]}")
+                        for name, sql in indexes]
+                    for _, ddl in scratch_indexes[scratch]:
+                        c.execute(ddl)
+                self.conn.commit()
+
+                if self.data is not None:
+                    # Clean once up front, so the to_sql leg does not load raw strings and neither leg pays for it
+                    self.count_rejected(clean_wines_frame(self.data))
+
+                start = time.perf_counter()
+                self.load_csv_into_table("compare_to_sql")
+                to_sql_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for name, _ in scratch_indexes["compare_bulk"]:
+                    c.execute(f"DROP INDEX {name}")
+                self.bulk_load_csv_into_table("compare_bulk", defer_indexes=False)
+                for _, ddl in scratch_indexes["compare_bulk"]:
+                    c.execute(ddl)
+                self.conn.commit()
+                bulk_time = time.perf_counter() - start
+
+                for scratch in ("compare_to_sql", "compare_bulk"):
+                    c.execute(f"DROP TABLE {scratch}")
+                self.conn.commit()
+
+                speedup = to_sql_time / bulk_time
+                print(f"to_sql: {to_sql_time:.2f}s, bulk load: {bulk_time:.2f}s, speedup: {speedup:.1f}x "
+                      f"({len(indexes)} secondary indexes)")
+                return speedup
+            except Error as e:
+                self._report_error(e)
         else:
             print("Connection to database refused!")
 
@@ -85,16 +920,111 @@ class WinesDataset:
         """
         if self.conn is not None:
             try:
-                c = self.conn.cursor()
-                c.execute("SELECT * FROM staging_wines")
-                rows = c.fetchall()
-                for row in rows:
+                for row in self.iter_rows("staging_wines"):
                     print(row)
             except Error as e:
-                print(e)
+                self._report_error(e)
         else:
             print("Connection to database refused!")
 
+    def iter_rows(self, table_name, columns=None, filters=None, batch_size=10000):
+        """
+        Stream the rows of a table, fetching batch_size rows at a time, memory stays constant.
+        :param table_name:
+        :param columns: columns to project, all by default
+        :param filters: dict column -> value, equality filters (None matches NULL)
+        :param batch_size: rows per fetchmany
+        :return: generator of row tuples
+        """
+        if self.conn is None:
+            print("Connection to database refused!")
+            return
+
+        with self._reader() as conn:
+            known = [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")]
+            columns = list(columns or known)
+            filters = filters or {}
+            for column in columns + list(filters):
+                if column not in known:
+                    raise KeyError(f"Bad column name: {column}")
+
+            query = f"SELECT {', '.join(columns)} FROM {table_name}"
+            if filters:
+                query += " WHERE " + " AND ".join(f"{column} IS ?" for column in filters)
+
+            c = conn.cursor()
+            self.connections.retry(c.execute, query, tuple(filters.values()))
+            while True:
+                rows = c.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+
+    def export_rows(self, path, table_name, columns=None, filters=None, batch_size=10000, file_format=None):
+        """
+        Export a table straight to a csv, jsonl or parquet file, batch by batch.
+        Parquet needs pyarrow.
+        :param path:
+        :param table_name:
+        :param columns: columns to project, all by default
+        :param filters: dict column -> value, equality filters
+        :param batch_size: rows per batch
+        :param file_format: "csv", "jsonl" or "parquet", taken from the extension by default
+        :return: number of rows written
+        """
+        if self.conn is None:
+            print("Connection to database refused!")
+            return
+
+        file_format = file_format or path.rsplit(".", 1)[-1].lower()
+        with self._reader() as conn:
+            declared = {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+        columns = list(columns or declared)
+        rows = self.iter_rows(table_name, columns, filters, batch_size)
+        written = 0
+
+        if file_format == "csv":
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                for row in rows:
+                    writer.writerow(row)
+                    written += 1
+
+        elif file_format == "jsonl":
+            with open(path, "w") as f:
+                for row in rows:
+                    f.write(json.dumps(dict(zip(columns, row))) + "\n")
+                    written += 1
+
+        elif file_format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            # Schema from the declared column types, a batch where a column is all NULL must not decide it
+            schema = pa.schema([(column, pa.type_for_alias(arrow_type(declared.get(column))))
+                                for column in columns])
+            writer = pq.ParquetWriter(path, schema)
+            batch = []
+            try:
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) == batch_size:
+                        writer.write_table(pa.Table.from_pylist([dict(zip(columns, r)) for r in batch], schema=schema))
+                        written += len(batch)
+                        batch = []
+                if batch:
+                    writer.write_table(pa.Table.from_pylist([dict(zip(columns, r)) for r in batch], schema=schema))
+                    written += len(batch)
+            finally:
+                writer.close()
+
+        else:
+            raise ValueError(f"Unknown export format: {file_format}")
+
+        return written
+
+    @holds_writer
     def populate_dim_tables(self):
         """
         Populate dim tables with staging_wines values
@@ -123,10 +1053,11 @@ class WinesDataset:
                 self.conn.commit()
 
             except Error as e:
-                print(e)
+                self._report_error(e)
         else:
             print("Connection to database refused!")
 
+    @holds_writer
     def populate_fact_table(self):
         """
         Add fk to staging table, clean data and populate FactWine
@@ -146,9 +1077,9 @@ class WinesDataset:
                           "price,"
                           "vintage)"
                           "SELECT staging_wines.title, "
-                          "dimvariety.variety_id, "
-                          "dimgeography.geography_id, "
                           "dimwinery.winery_id, "
+                          "dimgeography.geography_id, "
+                          "dimvariety.variety_id, "
                           "staging_wines.points, "
                           "staging_wines.price, "
                           "staging_wines.vintage "
@@ -159,24 +1090,305 @@ class WinesDataset:
                           "JOIN dimwinery ON staging_wines.winery == dimwinery.winery_name")
 
                 self.conn.commit()
+                self.refresh_summary_tables()
+
+            except Error as e:
+                self._report_error(e)
+        else:
+            print("Connection to database refused!")
+
+    @holds_writer
+    def populate_fact_table_cached(self, batch_size=DEFAULT_CHUNKSIZE, maxsize=None):
+        """
+        Populate FactWine without joins: the dimensions are loaded once into key caches and the
+        surrogate keys are resolved in python while the staging rows stream in, then written in bulk.
+        Like refresh_star_schema, only the staging rows above the high-water mark are read and the mark
+        moves in the same transaction, so running it again (or refresh_star_schema after it) appends nothing.
+        :param batch_size: staging rows fetched and fact rows written per batch
+        :param maxsize: max keys kept per dimension cache (LRU), None keeps the whole dimension
+        :return: number of fact rows inserted
+        """
+        if self.conn is not None:
+            try:
+                c = self.conn.cursor()
+                c.execute(sql_create_etl_watermark_table)
+                self.conn.commit()
+                low, high = self._staging_range(c)
+                if high is None or high <= low:
+                    print("Star schema already up to date!")
+                    return 0
+
+                winery = DimensionKeyCache(self.conn, "dimwinery", "winery_id", ("winery_name",), maxsize)
+                variety = DimensionKeyCache(self.conn, "dimvariety", "variety_id", ("variety",), maxsize)
+                geography = DimensionKeyCache(self.conn, "dimgeography", "geography_id",
+                                              ("country", "province", "county"), maxsize)
+
+                read = self.conn.cursor()
+                write = self.conn.cursor()
+                inserted = 0
+                with self.conn:
+                    read.execute("SELECT title, winery, variety, country, province, county, points, price, vintage "
+                                 "FROM staging_wines WHERE rowid > ? AND rowid <= ?", (low, high))
+                    while True:
+                        rows = read.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        facts = [(title,
+                                  winery.get((winery_name,)),
+                                  geography.get((country, province, county)),
+                                  variety.get((variety_name,)),
+                                  points, price, vintage)
+                                 for title, winery_name, variety_name, country, province, county, points, price,
+                                 vintage in rows]
+                        write.executemany("INSERT INTO factwine"
+                                          "(title,winery_id,geography_id,variety_id,points,price,vintage) "
+                                          "VALUES (?,?,?,?,?,?,?)", facts)
+                        inserted += len(facts)
+                    self._advance_staging_mark(write, high)
+                    self._refresh_summaries(write)
+
+                for cache in (winery, variety, geography):
+                    print(f"{cache.table}: {len(cache.keys)} keys cached, {cache.hits} hits, {cache.misses} misses")
+                return inserted
 
             except Error as e:
-                print(e)
+                self._report_error(e)
+        else:
+            print("Connection to database refused!")
+
+    @holds_writer
+    def refresh_star_schema(self):
+        """
+        Incremental and idempotent refresh of the dim and fact tables.
+        Only the staging rows above the high-water mark are read: new dimension members are upserted
+        against the unique natural keys and only the new fact rows are appended, all in one transaction.
+        Re-running without new staging rows is a no-op. Staging ids below the mark mean the table was
+        created again (or, for a staging table without staging_id, emptied and reloaded with fewer rows):
+        the mark goes back to 0 and the whole staging table is propagated.
+        :return: number of fact rows appended
+        """
+        if self.conn is not None:
+            try:
+                c = self.conn.cursor()
+                c.execute(sql_create_etl_watermark_table)
+                for ddl in DIM_NATURAL_KEYS:
+                    c.execute(ddl)
+                self.conn.commit()
+
+                low, high = self._staging_range(c)
+                if high is None or high <= low:
+                    print("Star schema already up to date!")
+                    return 0
+
+                with self.conn:
+                    c.execute("INSERT INTO dimwinery (winery_name) "
+                              "SELECT DISTINCT winery FROM staging_wines WHERE rowid > ? AND rowid <= ? "
+                              "ON CONFLICT DO NOTHING", (low, high))
+                    c.execute("INSERT INTO dimvariety (variety) "
+                              "SELECT DISTINCT variety FROM staging_wines WHERE rowid > ? AND rowid <= ? "
+                              "ON CONFLICT DO NOTHING", (low, high))
+                    c.execute("INSERT INTO dimgeography (country,province,county) "
+                              "SELECT DISTINCT country, province, county FROM staging_wines "
+                              "WHERE rowid > ? AND rowid <= ? "
+                              "ON CONFLICT DO NOTHING", (low, high))
+
+                    c.execute("INSERT INTO factwine(title,winery_id,geography_id,variety_id,points,price,vintage) "
+                              "SELECT s.title, w.winery_id, g.geography_id, v.variety_id, s.points, s.price, s.vintage "
+                              "FROM staging_wines s "
+                              "JOIN dimwinery w ON IFNULL(s.winery, '') = IFNULL(w.winery_name, '') "
+                              "JOIN dimvariety v ON IFNULL(s.variety, '') = IFNULL(v.variety, '') "
+                              "JOIN dimgeography g ON IFNULL(s.country, '') = IFNULL(g.country, '') "
+                              "AND IFNULL(s.province, '') = IFNULL(g.province, '') "
+                              "AND IFNULL(s.county, '') = IFNULL(g.county, '') "
+                              "WHERE s.rowid > ? AND s.rowid <= ?", (low, high))
+                    appended = c.rowcount
+
+                    self._advance_staging_mark(c, high)
+                    # Summaries move in the same transaction as the facts they aggregate
+                    self._refresh_summaries(c)
+
+                print(f"{appended} fact rows appended (staging rows {low + 1} to {high})")
+                return appended
+
+            except Error as e:
+                self._report_error(e)
+        else:
+            print("Connection to database refused!")
+
+    @staticmethod
+    def _staging_range(c):
+        """
+        Staging rows not yet propagated to the star schema: rowids above the high-water mark, up to the
+        current max. Ids below the mark mean the table was created again (or, for a staging table without
+        staging_id, emptied and reloaded with fewer rows): the mark goes back to 0.
+        :param c: cursor of the writer
+        :return: (low, high), high is None for an empty staging table
+        """
+        row = c.execute("SELECT last_rowid FROM etl_watermark WHERE source = 'staging_wines'").fetchone()
+        low = row[0] if row else 0
+        high = c.execute("SELECT MAX(rowid) FROM staging_wines").fetchone()[0]
+        if high is not None and high < low:
+            print(f"Staging ids went back below the high-water mark ({high} < {low}), starting again from 0")
+            low = 0
+        return low, high
+
+    @staticmethod
+    def _advance_staging_mark(c, high):
+        """
+        Move the star schema high-water mark, within the caller's transaction.
+        :param c: cursor of the writer
+        :param high: last staging rowid propagated
+        :return:
+        """
+        c.execute("INSERT INTO etl_watermark (source, last_rowid) VALUES ('staging_wines', ?) "
+                  "ON CONFLICT (source) DO UPDATE SET last_rowid = excluded.last_rowid", (high,))
+
+    def _refresh_summaries(self, c):
+        """
+        Fold the source rows above each summary high-water mark into the summary tables, without committing.
+        Counts and sums are added, min and max kept. A summary is rebuilt from scratch when rows of its
+        sources were deleted or updated since its last refresh (counted by triggers), when its sources were
+        not tracked yet (e.g. a table dropped and created again) or when the ids went back below the mark.
+        Missing source tables are skipped.
+        :param c: cursor of the writer
+        :return: dict summary table -> source rows folded in
+        """
+        c.execute(sql_create_etl_watermark_table)
+        c.execute(sql_create_etl_changes_table)
+        c.execute(sql_create_etl_summary_changes_table)
+        existing = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+        # Tables without triggers may have changed unnoticed, the summaries depending on them are rebuilt
+        tracked = tracked_sources(c)
+        sources = {name for table in SUMMARY_TABLES for name in summary_sources(table)} & existing
+        for source in sources - tracked:
+            c.execute("INSERT INTO etl_changes (source) VALUES (?) ON CONFLICT (source) DO NOTHING", (source,))
+            for event in ("delete", "update"):
+                c.execute(sql_create_change_trigger.format(source=source, event=event))
+
+        folded = {}
+        for table, (source, id_column, group_by) in SUMMARY_TABLES.items():
+            dependencies = summary_sources(table)
+            if not set(dependencies) <= existing:
+                continue
+            c.execute(sql_create_summary_table.format(table=table))
+            c.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_grp ON {table} (IFNULL(grp, ''))")
+
+            row = c.execute("SELECT last_rowid FROM etl_watermark WHERE source = ?", (table,)).fetchone()
+            low = row[0] if row else 0
+            high = c.execute(f"SELECT IFNULL(MAX({id_column}), 0) FROM {source}").fetchone()[0]
+            changes = self._source_changes(c, dependencies)
+            row = c.execute("SELECT changes FROM etl_summary_changes WHERE summary = ?", (table,)).fetchone()
+            if high < low or row is None or row[0] != changes or not set(dependencies) <= tracked:
+                c.execute(f"DELETE FROM {table}")
+                low = 0
+            if high > low:
+                join, column = GROUP_BY_DIMENSIONS[group_by] if group_by is not None else ("", "NULL")
+                c.execute(f"INSERT INTO {table} (grp, rows, price_count, price_sum, price_min, price_max, "
+                          f"points_count, points_sum, points_min, points_max) "
+                          f"SELECT {column}, COUNT(*), COUNT(f.price), TOTAL(f.price), MIN(f.price), MAX(f.price), "
+                          f"COUNT(f.points), TOTAL(f.points), MIN(f.points), MAX(f.points) "
+                          f"FROM {source} f {join} WHERE f.{id_column} > ? AND f.{id_column} <= ? GROUP BY {column} "
+                          f"ON CONFLICT (IFNULL(grp, '')) DO UPDATE SET "
+                          f"rows = rows + excluded.rows, "
+                          f"price_count = price_count + excluded.price_count, "
+                          f"price_sum = price_sum + excluded.price_sum, "
+                          f"price_min = IFNULL(MIN(price_min, excluded.price_min), "
+                          f"IFNULL(price_min, excluded.price_min)), "
+                          f"price_max = IFNULL(MAX(price_max, excluded.price_max), "
+                          f"IFNULL(price_max, excluded.price_max)), "
+                          f"points_count = points_count + excluded.points_count, "
+                          f"points_sum = points_sum + excluded.points_sum, "
+                          f"points_min = IFNULL(MIN(points_min, excluded.points_min), "
+                          f"IFNULL(points_min, excluded.points_min)), "
+                          f"points_max = IFNULL(MAX(points_max, excluded.points_max), "
+                          f"IFNULL(points_max, excluded.points_max))", (low, high))
+            c.execute("INSERT INTO etl_watermark (source, last_rowid) VALUES (?, ?) "
+                      "ON CONFLICT (source) DO UPDATE SET last_rowid = excluded.last_rowid", (table, high))
+            c.execute("INSERT INTO etl_summary_changes (summary, changes) VALUES (?, ?) "
+                      "ON CONFLICT (summary) DO UPDATE SET changes = excluded.changes", (table, changes))
+            folded[table] = high - low
+        return folded
+
+    @staticmethod
+    def _source_changes(conn, sources):
+        """
+        Deletes and updates counted so far on a list of tables.
+        :param conn: cursor or connection
+        :param sources:
+        :return: int
+        """
+        placeholders = ",".join("?" * len(sources))
+        return conn.execute(f"SELECT IFNULL(SUM(changes), 0) FROM etl_changes WHERE source IN ({placeholders})",
+                            sources).fetchone()[0]
+
+    @holds_writer
+    def refresh_summary_tables(self):
+        """
+        Incremental maintenance of the materialized aggregates of staging_wines and factwine, in one
+        transaction. Only the rows loaded since the last refresh are read. Called after every load.
+        :return: dict summary table -> source rows folded in
+        """
+        if self.conn is not None:
+            try:
+                with self.conn:
+                    return self._refresh_summaries(self.conn.cursor())
+            except Error as e:
+                self._report_error(e)
+        else:
+            print("Connection to database refused!")
+
+    def _summary_rows(self, conn, table):
+        """
+        Rows of a summary table if it is up to date with its sources, None otherwise (stale or never built),
+        in which case the caller scans the source. Up to date means no row was loaded above its mark and no
+        row was deleted or updated since its last refresh.
+        :param conn:
+        :param table:
+        :return: list of WineSummary or None
+        """
+        source, id_column, _ = SUMMARY_TABLES[table]
+        dependencies = summary_sources(table)
+        try:
+            row = conn.execute("SELECT last_rowid FROM etl_watermark WHERE source = ?", (table,)).fetchone()
+            high = conn.execute(f"SELECT IFNULL(MAX({id_column}), 0) FROM {source}").fetchone()[0]
+            if row is None or row[0] != high or not set(dependencies) <= tracked_sources(conn):
+                return None
+            row = conn.execute("SELECT changes FROM etl_summary_changes WHERE summary = ?", (table,)).fetchone()
+            if row is None or row[0] != self._source_changes(conn, dependencies):
+                return None
+            return [WineSummary(*row) for row in conn.execute(f"SELECT * FROM {table} ORDER BY grp")]
+        except Error:
+            return None
+
+    def get_summary(self, group_by=None):
+        """
+        Materialized count, sum, min and max of price and points of factwine.
+        :param group_by: None, "variety", "country", "winery" or "vintage"
+        :return: list of WineSummary (one per group, a single one for the totals), None if the summary is stale
+        """
+        if self.conn is not None:
+            table = "summary_factwine" if group_by is None else f"summary_factwine_{group_by}"
+            with self._reader() as conn:
+                return self._summary_rows(conn, table)
         else:
             print("Connection to database refused!")
 
     def count_total_table_rows_sw(self):
         """
-        Count all rows from table staging_wines
+        Count all rows from table staging_wines, from its summary when it is up to date.
         :return:
         """
         if self.conn is not None:
             try:
-                c = self.conn.cursor()
-                total = c.execute("SELECT Count(*) FROM staging_wines")
-                return total.fetchone()
+                with self._reader() as conn:
+                    summary = self._summary_rows(conn, "summary_staging_wines")
+                    if summary is not None:
+                        return (summary[0].rows if summary else 0),
+                    total = self.connections.retry(conn.execute, "SELECT Count(*) FROM staging_wines")
+                    return total.fetchone()
             except Error as e:
-                print(e)
+                self._report_error(e)
         else:
             print("Connection to database refused!")
 
@@ -185,23 +1397,89 @@ class WinesDataset:
         Get average price of a bottle of wine.
         The price datatype is TEXT, then we need to clean the data to perform de avg operation.
         Dataset cleaned !
-        The process can be done directly into sql into CAST operator.
-        Process the data after query them seems easier and more understandable.
-        :return:
+        The aggregation is done by SQLite in a single pass, nothing is pulled into python, or read from
+        the staging summary when it is up to date.
+        :return: PriceStats
         """
         if self.conn is not None:
             try:
-                c = self.conn.cursor()
-                prices = c.execute("SELECT price FROM staging_wines WHERE price IS NOT NULL").fetchall()
-                total = 0
-                for x in prices:
-                    total += x[0]
+                with self._reader() as conn:
+                    summary = self._summary_rows(conn, "summary_staging_wines")
+                    if summary is not None:
+                        count, avg, low, high = summary_price_stats(summary[0] if summary else None)[1:]
+                    else:
+                        count, avg, low, high = self.connections.retry(
+                            conn.execute, "SELECT COUNT(price), AVG(price), MIN(price), MAX(price) FROM staging_wines"
+                        ).fetchone()
 
-                print("Average Price = ", total / len(prices))
-                print("Price of most expensive wine = ", max(prices))
+                print("Average Price = ", avg)
+                print("Price of most expensive wine = ", high)
+
+                return PriceStats(None, count, avg, low, high)
 
             except Error as e:
-                print(e)
+                self._report_error(e)
+        else:
+            print("Connection to database refused!")
+
+    def get_price_stats(self, group_by=None):
+        """
+        Count, average, min and max price of factwine, read from the summary tables when they are up to
+        date (one row per group), computed in the engine otherwise.
+        :param group_by: None, "variety", "country", "winery" or "vintage"
+        :return: PriceStats, or a list of PriceStats (one per group) when grouped
+        """
+        if self.conn is not None:
+            try:
+                with self._reader() as conn:
+                    table = "summary_factwine" if group_by is None else f"summary_factwine_{group_by}"
+                    summary = self._summary_rows(conn, table)
+                    if summary is not None and group_by is None:
+                        return summary_price_stats(summary[0] if summary else None)
+                    if summary is not None:
+                        return [summary_price_stats(row) for row in summary]
+
+                    if group_by is None:
+                        row = self.connections.retry(
+                            conn.execute, "SELECT COUNT(price), AVG(price), MIN(price), MAX(price) FROM factwine"
+                        ).fetchone()
+                        return PriceStats(None, *row)
+
+                    join, column = GROUP_BY_DIMENSIONS[group_by]
+                    rows = self.connections.retry(
+                        conn.execute, f"SELECT {column}, COUNT(f.price), AVG(f.price), MIN(f.price), MAX(f.price) "
+                                      f"FROM factwine f {join} GROUP BY {column} ORDER BY {column}")
+                    return [PriceStats(*row) for row in rows]
+            except Error as e:
+                self._report_error(e)
+        else:
+            print("Connection to database refused!")
+
+    def get_price_percentiles(self, percentiles=(0.25, 0.5, 0.75), group_by=None):
+        """
+        Nearest-rank price percentiles of factwine, ranked by SQLite window functions.
+        :param percentiles: values in ]0, 1]
+        :param group_by: None, "variety", "country", "winery" or "vintage"
+        :return: list of PricePercentile
+        """
+        if self.conn is not None:
+            try:
+                join, column = GROUP_BY_DIMENSIONS[group_by] if group_by is not None else ("", "NULL")
+                values = ", ".join("(?)" for _ in percentiles)
+                query = (f"WITH ranked AS ("
+                         f"SELECT {column} AS grp, f.price, "
+                         f"ROW_NUMBER() OVER (PARTITION BY {column} ORDER BY f.price) AS rn, "
+                         f"COUNT(*) OVER (PARTITION BY {column}) AS n "
+                         f"FROM factwine f {join} WHERE f.price IS NOT NULL), "
+                         f"wanted(p) AS (VALUES {values}) "
+                         f"SELECT grp, p, price FROM ranked JOIN wanted "
+                         f"ON rn = MAX(1, -CAST(-p * n AS INTEGER)) "
+                         f"ORDER BY grp, p")
+                with self._reader() as conn:
+                    rows = self.connections.retry(conn.execute, query, tuple(percentiles))
+                    return [PricePercentile(*row) for row in rows]
+            except Error as e:
+                self._report_error(e)
         else:
             print("Connection to database refused!")
 
@@ -210,35 +1488,27 @@ class WinesDataset:
         Close connection to database.
         :return:
         """
-        if self.conn:
+        if self.connections is not None:
+            self.connections.close()
+            self.connections = None
+            self.conn = None
+        elif self.conn:
             self.conn.close()
 
 
 if __name__ == '__main__':
-    file_path = "/home/joaocps/Koodoo/Koodoo_Data_Intern/"
-    file_name = "Wines.csv"
+    # Wines csv and database paths, the cli (cli.py wines load / stats) runs the same steps with options
+    csv_file = sys.argv[1] if len(sys.argv) > 1 else "Wines.csv"
+    db_file = sys.argv[2] if len(sys.argv) > 2 else "Wine.db"
 
-    challenge = WinesDataset(file_path + file_name)
+    challenge = WinesDataset(csv_file)
 
-    challenge.create_db_connection("Wine.db")
+    challenge.create_db_connection(db_file)
 
     # TASK 1
     print(challenge.get_csv_data_types())
 
     # staging_wines table creation with correct data types
-    sql_create_staging_wines_table = """ CREATE TABLE IF NOT EXISTS staging_wines (
-    vintage TEXT,
-    country TEXT,
-    county TEXT,
-    designation TEXT,
-    points INTEGER,
-    price REAL,
-    province TEXT,
-    title TEXT,
-    variety TEXT,
-    winery TEXT);
-    """
-
     challenge.create_db_table(sql_create_staging_wines_table)
 
     # Load the csv into staging_wines table
@@ -254,48 +1524,16 @@ if __name__ == '__main__':
     print(challenge.get_price_info())
 
     # TASK 2 - Create tables with relationships
-
-    sql_create_dim_winery_table = """CREATE TABLE IF NOT EXISTS dimwinery (
-    winery_id INTEGER PRIMARY KEY,
-    winery_name TEXT)
-    """
-
-    sql_create_dim_geography_table = """CREATE TABLE IF NOT EXISTS dimgeography (
-    geography_id INTEGER PRIMARY KEY,
-    country TEXT,
-    province TEXT,
-    county TEXT)
-    """
-
-    sql_create_dim_variety_table = """CREATE TABLE IF NOT EXISTS dimvariety (
-    variety_id INTEGER PRIMARY KEY,
-    variety TEXT)
-    """
-
-    # MANY - TO - ONE relationships, one wine have one winery but one winery can have many wines
-    sql_create_fact_wine_table = """CREATE TABLE IF NOT EXISTS factwine (
-    wine_id INTEGER PRIMARY KEY,
-    title TEXT,
-    winery_id INTEGER,
-    geography_id INTEGER,
-    variety_id INTEGER,
-    points INTEGER,
-    price REAL,
-    vintage TEXT,
-    FOREIGN KEY (winery_id) REFERENCES dimwinery (winery_id),
-    FOREIGN KEY (geography_id) REFERENCES dimgeography (geography_id),
-    FOREIGN KEY (variety_id) REFERENCES dimvariety (variety_id)
-    )
-    """
-
     challenge.create_db_table(sql_create_dim_winery_table)
     challenge.create_db_table(sql_create_dim_geography_table)
     challenge.create_db_table(sql_create_dim_variety_table)
     challenge.create_db_table(sql_create_fact_wine_table)
 
+    # Natural key and fk indexes, so the joins below do not scan
+    challenge.create_indexes()
+
     # The dim tables needs to be populated first
     challenge.populate_dim_tables()
 
     # Add fk references to staging table
     challenge.populate_fact_table()
-
@@ -17,20 +17,186 @@ jcps@ua.pt
 Data Science Task for Data Intern Position at Koodoo.
 """
 
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import functools
+import os
+import sys
 
-# For display purposes
-pd.set_option('display.width', 400)
-pd.set_option("display.max.columns", None)
+from collections import namedtuple
 
+import numpy as np
+import pandas as pd
 
+# Shared modules live at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from categorical_encoding import CategoricalEncoder, cramers_v_matrix
+from correlation_engine import (CorrelationEngine, correlation_pairs, numeric_columns, rank_correlation,
+                                top_correlation_pairs)
+from frame_cache import FrameCache
+from instrumentation import instrument_public_methods
+from lazy_import import lazy_import
+from report_rendering import draw_price_boxplot, render_cached, render_jobs
+from sketches import HeavyHitters, HyperLogLog, update_grouped_quantiles
+from task_runner import AsyncTaskRunner
+
+# Plotting libraries are only imported by the methods drawing on screen
+plt = lazy_import("matplotlib.pyplot")
+sns = lazy_import("seaborn")
+
+
+def set_display_options():
+    """
+    For display purposes, set by the scripts printing frames rather than at import.
+    :return:
+    """
+    pd.set_option('display.width', 400)
+    pd.set_option("display.max.columns", None)
+
+
+# Figures of the rendered report
+REPORT_FIGURES = ["correlation", "neighbourhood_group", "price_by_state", "price_by_room"]
+
+
+# Format of host_since, parsing with an explicit format avoids per value format inference
+HOST_SINCE_FORMAT = "%Y-%m-%d"
+
+# dtypes: column -> dtype
+# object_types: object/string column -> (inferred type of the values, non null count, null count)
+# null_counts: column -> number of nulls
+# memory_bytes: column -> memory used, strings included
+TypeProfile = namedtuple("TypeProfile", ["dtypes", "object_types", "null_counts", "memory_bytes"])
+
+
+def profile_types(frame):
+    """
+    Vectorized type profile: dtype inference and NA masks, without copying the frame or calling Python per cell.
+    :param frame:
+    :return: TypeProfile
+    """
+    null_counts = frame.isna().sum()
+    object_types = {}
+    for column in frame.select_dtypes(include=["object", "string"]).columns:
+        non_null = len(frame) - int(null_counts[column])
+        object_types[column] = (pd.api.types.infer_dtype(frame[column], skipna=True), non_null,
+                                int(null_counts[column]))
+    return TypeProfile(frame.dtypes, object_types, null_counts, frame.memory_usage(index=False, deep=True))
+
+
+def downcast_numeric(frame):
+    """
+    Downcast integer columns to the smallest integer type holding their values, and float columns to float32
+    when that loses nothing. In place.
+    :param frame:
+    :return:
+    """
+    for column in frame.select_dtypes(include=["integer"]).columns:
+        frame[column] = pd.to_numeric(frame[column], downcast="integer")
+    for column in frame.select_dtypes(include=["float64"]).columns:
+        values = frame[column].to_numpy()
+        narrow = values.astype(np.float32)
+        if np.array_equal(narrow, values, equal_nan=True):
+            frame[column] = narrow
+
+
+def clean_frame(frame, downcast=True):
+    """
+    NaN filling and boolean mapping of clean_dataset, in place, also used on chunks by ChunkedAirbnbDataset.
+    Only the columns that need it are replaced, the frame is never copied as a whole.
+    :param frame: airbnb dataframe (or chunk)
+    :param downcast: downcast the numeric columns (see downcast_numeric)
+    :return:
+    """
+    values = {
+        "beds": 0,
+        "bathrooms": 0,
+        "bedrooms": 0,
+        "reviews_per_month": 0
+    }
+
+    # Convert host_since to datetime64
+    if not pd.api.types.is_datetime64_any_dtype(frame["host_since"]):
+        frame["host_since"] = pd.to_datetime(frame["host_since"], format=HOST_SINCE_FORMAT, errors="coerce")
+
+    # Convert host_is_superhost to the nullable boolean type, 't' -> True, 'f' -> False, missing -> False
+    if not pd.api.types.is_bool_dtype(frame["host_is_superhost"]):
+        superhost = frame["host_is_superhost"]
+        frame["host_is_superhost"] = pd.arrays.BooleanArray(superhost.eq("t").to_numpy(dtype=bool, na_value=False),
+                                                            np.zeros(len(superhost), dtype=bool))
+    elif frame["host_is_superhost"].hasnans:
+        frame["host_is_superhost"] = frame["host_is_superhost"].fillna(False)
+
+    # Fill NaN Values
+    for column, value in values.items():
+        if frame[column].hasnans:
+            frame[column] = frame[column].fillna(value)
+
+    if downcast:
+        downcast_numeric(frame)
+
+
+@instrument_public_methods
 class AirbnbDataset:
 
-    def __init__(self, file):
-        self.data = pd.read_csv(file)
+    def __init__(self, file, instrumentation=None, cache_dir=None):
+        """
+        :param file: airbnb csv
+        :param instrumentation: Instrumentation recording every public method as a stage
+        :param cache_dir: if given, the parsed csv is cached there (see FrameCache)
+        """
+        self.file = file
+        self.instrumentation = instrumentation
+        self.cache = FrameCache(cache_dir) if cache_dir is not None else None
+        self.correlation_matrix = None
+        self.correlation_method = None
+        self.correlation_engine = None
+        self.grouped_stats = {}
+        # Vocabularies learned by encode_object_types, reused for every later dataframe or batch
+        self.encoder = CategoricalEncoder()
+        self.data = self.read_csv()
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, frame):
+        # Replacing the data makes every derived statistic stale
+        self._data = frame
+        self.invalidate_statistics()
+
+    def invalidate_statistics(self):
+        """
+        Drop the cached statistics, to be called after any change of the data.
+        :return:
+        """
         self.correlation_matrix = None
+        self.correlation_method = None
+        self.correlation_engine = None
+        self.grouped_stats = {}
+
+    def append_rows(self, frame):
+        """
+        Append new rows. A pearson correlation already computed is updated from the new rows only.
+        :param frame: rows with the dataset columns
+        :return: new shape
+        """
+        self._data = pd.concat([self._data, frame], ignore_index=True)
+        if self.correlation_engine is not None and self.correlation_method == "pearson":
+            self.correlation_matrix = self.correlation_engine.update(frame).correlation()
+            self.grouped_stats = {}
+        else:
+            self.invalidate_statistics()
+        return self._data.shape
+
+    def read_csv(self):
+        """
+        Read the whole csv. With a cache, the csv is parsed once and then memory-mapped from the cache
+        until it changes.
+        :return: dataframe
+        """
+        if self.cache is None:
+            return pd.read_csv(self.file)
+        return self.cache.get_or_parse(self.file, "pd.read_csv", lambda: pd.read_csv(self.file))
 
     def get_dataset_shape(self):
         """
@@ -49,68 +215,82 @@ class AirbnbDataset:
         We can see here that some features need some cleaning!
         Features without datatype (object) can't be analyzed properly.
         [host_since, host_is_superhost, State, neighbourhood_group, room_type, bathrooms] -> object
-        :return: data types
+        :return: TypeProfile
         """
+        profile = profile_types(self.data)
         # Some problems here!
-        print(self.data.dtypes)
+        print(profile.dtypes)
 
         # Host_since feature have 158255 str values and 29 float values, probably null/NaN!
-        df = self.data.copy()
-        obj_features = ["host_since", "host_is_superhost", "State", "neighbourhood_group", "room_type", "bathrooms"]
-        for obj in obj_features:
-            print(df[obj].apply(type).value_counts())
-
-        # NaN values here, need to be fixed!
-        for value in df["bathrooms"]:
-            if isinstance(value, float):
-                print(value)
+        for column, (inferred, non_null, nulls) in profile.object_types.items():
+            print(f"{column}: {non_null} {inferred} values, {nulls} null")
 
         # Count null attr can be usefull!
-        print(df.isnull().sum())
+        print(profile.null_counts)
 
-        return self.data.dtypes
+        return profile
 
-    def encode_object_types(self, test_dataframe, feature):
+    def encode_object_types(self, test_dataframe, feature, encoding='dummies', n_features=1024):
         """
-        Can be useful to encode object data types to further analysis
-        ToDO:-> https://towardsdatascience.com/the-search-for-categorical-correlation-a1cf7f1888c9
+        Can be useful to encode object data types to further analysis.
+        The sparse encodings reuse the vocabulary learned the first time a feature is encoded, so every
+        batch gets the same columns.
         :param test_dataframe:
         :param feature:
-        :return:
+        :param encoding: "dummies" (dense one-hot), "codes" (int32 category codes, -1 if unknown),
+        "sparse" (one-hot with SparseDtype columns) or "hashed" (scipy CSR of n_features hashed columns,
+        for very high cardinality)
+        :param n_features: width of the hashed encoding
+        :return: test_dataframe with the encoded columns, the CSR matrix for "hashed"
         """
-        dummies = pd.get_dummies(test_dataframe[[feature]])
+        if encoding == 'dummies':
+            dummies = pd.get_dummies(test_dataframe[[feature]])
+        elif encoding == 'codes':
+            dummies = pd.DataFrame({f"{feature}_code": self.encoder.codes(test_dataframe, feature)},
+                                   index=test_dataframe.index)
+        elif encoding == 'sparse':
+            dummies = self.encoder.one_hot(test_dataframe, feature)
+        elif encoding == 'hashed':
+            return self.encoder.hashed(test_dataframe, feature, n_features)
+        else:
+            raise ValueError(f"Unknown encoding: {encoding}")
         res = pd.concat([test_dataframe, dummies], axis=1)
         return res
 
+    def get_categorical_association(self, columns=None, bias_correction=True):
+        """
+        Cramér's V between categorical features, computed from their contingency tables.
+        https://towardsdatascience.com/the-search-for-categorical-correlation-a1cf7f1888c9
+        :param columns: object/category/boolean columns by default
+        :param bias_correction:
+        :return: association matrix dataframe
+        """
+        if columns is None:
+            columns = list(self.data.select_dtypes(include=["object", "string", "category", "bool", "boolean"])
+                           .columns.drop("host_since", errors="ignore"))
+        return cramers_v_matrix(self.data, columns, bias_correction)
+
     def clean_dataset(self):
         """
         We could explore the data set a lot more if it related categorical variables using dummy variables,
         but it seems to me that at this moment this is not what we are looking for. then we do a little cleaning
-        of NaN values ​​and boolean mapping.
-        Future work -> https://towardsdatascience.com/the-search-for-categorical-correlation-a1cf7f1888c9
-        :return:
+        of NaN values and boolean mapping, in place, and downcast the numeric columns.
+        Categorical association -> get_categorical_association
+        :return: TypeProfile of the cleaned data
         """
-        values = {
-            "host_is_superhost": False,
-            "beds": 0,
-            "bathrooms": 0,
-            "bedrooms": 0,
-            "reviews_per_month": 0
-        }
-
-        boolean = {
-            't': True,
-            'f': False
-        }
-
-        # Convert host_since to datetime64
-        self.data["host_since"] = pd.to_datetime(self.data['host_since'], errors='coerce')
-        # Convert host_is_superhost do boolean
-        self.data["host_is_superhost"] = self.data["host_is_superhost"].replace(boolean)
-        # Fill NaN Values
-        self.data.fillna(value=values, inplace=True)
+        clean_frame(self.data)
+        # The data changed in place
+        self.invalidate_statistics()
+        profile = profile_types(self.data)
         # Null values feedback
-        print(self.data.isnull().sum())
+        print(profile.null_counts)
+        return profile
+
+    def get_null_counts(self):
+        """
+        :return: number of null values per column
+        """
+        return self.data.isnull().sum()
 
     def get_unique_values(self, column_name):
         """
@@ -144,22 +324,88 @@ class AirbnbDataset:
             # Just for logging error handling
             print("Bad column name")
 
-    def get_correlation(self):
+    def get_price_quantile_sketches(self, group_column, price_limit=None, k=200):
+        """
+        One KLL quantile sketch of the price per group, mergeable with sketches of other partitions
+        and serializable with sketches.save_sketches.
+        :param group_column: e.g. State or room_type
+        :param price_limit: only prices below it, like the price distribution plots
+        :param k: sketch accuracy
+        :return: dict group -> KLLSketch
         """
-        Get correlations between all numerical features with pearson method
+        data = self.data if price_limit is None else self.data[self.data.price < price_limit]
+        return update_grouped_quantiles({}, data, group_column, "price", k)
+
+    def get_approximate_unique_count(self, column_name, precision=14):
+        """
+        Approximate number of different values along a column (HyperLogLog).
+        :param column_name:
+        :param precision:
+        :return: estimated count
+        """
+        try:
+            return HyperLogLog(precision).update(self.data[column_name]).count()
+        except KeyError:
+            # Just for logging error handling
+            print("Bad column name")
+
+    def get_top_values(self, column_name, k=10, capacity=100):
+        """
+        Most frequent values of a column from a bounded heavy hitters summary.
+        :param column_name:
+        :param k:
+        :param capacity: counters kept
+        :return: list of (value, count)
+        """
+        try:
+            return HeavyHitters(capacity).update(self.data[column_name]).top(k)
+        except KeyError:
+            # Just for logging error handling
+            print("Bad column name")
+
+    def get_correlation(self, method='pearson'):
+        """
+        Get correlations between all numerical features, pearson method by default.
+        Pearson keeps running sufficient statistics (see CorrelationEngine), so appended rows update the
+        matrix without a full recompute. The matrix is cached until the data changes.
+        :param method: pearson, spearman or kendall
         :return: correlation matrix
         """
-        self.correlation_matrix = self.data.corr(method='pearson')
+        if self.correlation_matrix is not None and self.correlation_method == method:
+            return self.correlation_matrix
+
+        columns = numeric_columns(self.data)
+        if method == 'pearson':
+            self.correlation_engine = CorrelationEngine(columns).update(self.data)
+            self.correlation_matrix = self.correlation_engine.correlation()
+        else:
+            self.correlation_engine = None
+            self.correlation_matrix = rank_correlation(self.data[columns], method)
+        self.correlation_method = method
         return self.correlation_matrix
 
     def get_ordered_correlations(self):
         """
-        Use the correlation matrix, unstack, sort the values and remove duplicates like diagonal 1's
+        Use the correlation matrix, keep every pair of columns once (upper triangle, no diagonal 1's) and
+        sort the values. Distinct pairs with the same coefficient are all kept.
         :return: ordered values
         """
         if self.correlation_matrix is None:
             self.get_correlation()
-        return self.correlation_matrix.unstack().sort_values().drop_duplicates()
+        rows, columns, pairs = correlation_pairs(self.correlation_matrix)
+        names = self.correlation_matrix.columns
+        ordered = pd.Series(pairs, index=pd.MultiIndex.from_arrays([names[rows], names[columns]]))
+        return ordered.sort_values(kind="stable")
+
+    def get_top_correlations(self, k=10, order='absolute'):
+        """
+        The k most correlated pairs of features, without sorting the whole matrix.
+        Scales to wide matrices, e.g. after encode_object_types.
+        :param k:
+        :param order: 'positive', 'negative' or 'absolute'
+        :return: dataframe with feature_a, feature_b and correlation
+        """
+        return top_correlation_pairs(self.get_correlation(), k, order)
 
     def generate_correlation_plot(self):
         if self.correlation_matrix is None:
@@ -187,88 +433,322 @@ class AirbnbDataset:
         plt.style.use('fivethirtyeight')
         plt.figure(figsize=(13, 7))
         plt.title("Neighbourhood Group")
-        param = plt.pie(self.data.neighbourhood_group.value_counts(),
-                    labels=self.data.neighbourhood_group.value_counts().index,
+        counts = self.data.neighbourhood_group.value_counts()
+        param = plt.pie(counts,
+                    labels=counts.index,
                     autopct='%1.1f%%',
                     startangle=180
                     )
         plt.show()
 
-    def generate_price_distribution_by_state_plot(self):
+    def get_grouped_price_stats(self, group_column, price_limit=None):
+        """
+        Box plot statistics of the price per category, computed once with vectorized groupbys and cached
+        until the data changes: count, quartiles and whiskers (furthest prices within 1.5 IQR of the box,
+        like seaborn). Categories keep their order of appearance, like seaborn.
+        :param group_column: e.g. State or room_type
+        :param price_limit: only prices below it
+        :return: dataframe indexed by category with count, whislo, q1, med, q3, whishi
+        """
+        key = (group_column, price_limit)
+        if key not in self.grouped_stats:
+            data = self.data if price_limit is None else self.data[self.data.price < price_limit]
+            data = data[[group_column, "price"]].dropna()
+            groups = data.groupby(group_column, sort=False, observed=True)["price"]
+
+            stats = groups.quantile([0.25, 0.5, 0.75]).unstack()
+            stats.columns = ["q1", "med", "q3"]
+            stats.insert(0, "count", groups.size())
+            iqr = stats.q3 - stats.q1
+
+            low = data[group_column].map(stats.q1 - 1.5 * iqr)
+            high = data[group_column].map(stats.q3 + 1.5 * iqr)
+            price = data["price"]
+            stats["whislo"] = price[price >= low].groupby(data[group_column], observed=True).min()
+            stats["whishi"] = price[price <= high].groupby(data[group_column], observed=True).max()
+            self.grouped_stats[key] = stats[["count", "whislo", "q1", "med", "q3", "whishi"]]
+        return self.grouped_stats[key]
+
+    def get_price_boxes(self, group_column, price_limit):
         """
-        https://stackoverflow.com/questions/38649501/labeling-boxplot-in-seaborn-with-median-value
-        Best way to label the plot with median value!
+        Box plot input (see Axes.bxp) from get_grouped_price_stats, only the outliers come from the data.
+        :param group_column:
+        :param price_limit: only prices below it
+        :return: list of dicts
+        """
+        stats = self.get_grouped_price_stats(group_column, price_limit)
+
+        data = self.data[self.data.price < price_limit]
+        low = data[group_column].map(stats.whislo)
+        high = data[group_column].map(stats.whishi)
+        outliers = data.price[(data.price < low) | (data.price > high)].groupby(data[group_column], observed=True)
+
+        boxes = []
+        for category, row in stats.iterrows():
+            box = {key: float(value) for key, value in row.items()}
+            box["label"] = str(category)
+            box["fliers"] = (outliers.get_group(category).to_numpy(dtype=np.float64)
+                             if category in outliers.groups else np.empty(0))
+            boxes.append(box)
+        return boxes
+
+    def generate_price_distribution_plot(self, group_column, price_limit, title):
+        """
+        Price box plot per category, drawn from get_grouped_price_stats and labeled with the medians.
+        :param group_column:
+        :param price_limit: only prices below it
+        :param title:
         :return:
         """
         plt.style.use('classic')
-        plt.figure(figsize=(13, 7))
-        plt.title("Price Distribution by State")
-        box_plot = sns.boxplot(y="price", x='State', data=self.data[self.data.price < 450])
-
-        ax = box_plot.axes
-        lines = ax.get_lines()
-        categories = ax.get_xticks()
-
-        for cat in categories:
-            # every 4th line at the interval of 6 is median line
-            # 0 -> p25 1 -> p75 2 -> lower whisker 3 -> upper whisker 4 -> p50 5 -> upper extreme value
-            y = round(lines[4 + cat * 6].get_ydata()[0], 1)
-
-            ax.text(
-                cat,
-                y,
-                f'{y}',
-                ha='center',
-                va='center',
-                fontweight='bold',
-                size=10,
-                color='white',
-                bbox=dict(facecolor='#445A64'))
-
-        box_plot.figure.tight_layout()
+        figure, ax = plt.subplots(figsize=(13, 7))
+        draw_price_boxplot(ax, self.get_price_boxes(group_column, price_limit), title, group_column)
+        figure.tight_layout()
         plt.show()
 
+    def generate_price_distribution_by_state_plot(self):
+        """
+        Price distribution by state, labeled with the median values.
+        :return:
+        """
+        self.generate_price_distribution_plot('State', 450, "Price Distribution by State")
+
     def generate_price_distribution_by_room_plot(self):
         """
-        https://stackoverflow.com/questions/38649501/labeling-boxplot-in-seaborn-with-median-value
-        Best way to label the plot with median value!
+        Price distribution by room type, labeled with the median values.
         :return:
         """
-        plt.style.use('classic')
-        plt.figure(figsize=(13, 7))
-        plt.title("Price Distribution by Room Type")
-        box_plot = sns.boxplot(y="price", x='room_type', data=self.data[self.data.price < 400])
-
-        ax = box_plot.axes
-        lines = ax.get_lines()
-        categories = ax.get_xticks()
-
-        for cat in categories:
-            # every 4th line at the interval of 6 is median line
-            # 0 -> p25 1 -> p75 2 -> lower whisker 3 -> upper whisker 4 -> p50 5 -> upper extreme value
-            y = round(lines[4 + cat * 6].get_ydata()[0], 1)
-
-            ax.text(
-                cat,
-                y,
-                f'{y}',
-                ha='center',
-                va='center',
-                fontweight='bold',
-                size=10,
-                color='white',
-                bbox=dict(facecolor='#445A64'))
-
-        box_plot.figure.tight_layout()
-        plt.show()
+        self.generate_price_distribution_plot('room_type', 400, "Price Distribution by Room Type")
+
+    def get_report_job(self, name):
+        """
+        One figure of the report as a compact rendering job (numpy arrays and plain parameters).
+        :param name: correlation, neighbourhood_group, price_by_state or price_by_room
+        :return: job dict for report_rendering
+        """
+        if name == "correlation":
+            correlation = self.get_correlation()
+            return {"kind": "correlation", "name": name,
+                    "values": correlation.to_numpy(dtype=np.float64), "labels": [str(c) for c in correlation.columns]}
+        if name == "neighbourhood_group":
+            counts = self.data.neighbourhood_group.value_counts()
+            return {"kind": "pie", "name": name, "title": "Neighbourhood Group",
+                    "counts": counts.to_numpy(), "labels": [str(c) for c in counts.index]}
+        if name == "price_by_state":
+            return {"kind": "price_boxplot", "name": name, "title": "Price Distribution by State",
+                    "xlabel": "State", "boxes": self.get_price_boxes('State', 450)}
+        if name == "price_by_room":
+            return {"kind": "price_boxplot", "name": name, "title": "Price Distribution by Room Type",
+                    "xlabel": "room_type", "boxes": self.get_price_boxes('room_type', 400)}
+        raise ValueError(f"Unknown report figure: {name}")
+
+    def get_report_jobs(self):
+        """
+        :return: list of job dicts of every report figure
+        """
+        return [self.get_report_job(name) for name in REPORT_FIGURES]
+
+    def render_report(self, output_dir, formats=("png",), workers=None):
+        """
+        Headless batch rendering of the correlation, neighbourhood group and price distribution figures
+        to files, on the Agg backend in a process pool. Figures whose data and parameters did not change
+        since the last render are skipped.
+        :param output_dir:
+        :param formats: e.g. ("png", "svg")
+        :param workers: pool processes
+        :return: dict figure name -> list of files
+        """
+        return render_jobs(self.get_report_jobs(), output_dir, formats, workers)
+
+    def build_report_runner(self, output_dir=None, formats=("png",), max_workers=None, process_workers=None):
+        """
+        The analysis of __main__ as a dependency graph for AsyncTaskRunner: the raw reads come before
+        clean_dataset (it changes the data in place), the statistics after it, the ordered correlations and
+        the correlation figure after the correlation. With an output_dir the figures are rendered headless in
+        the process pool.
+        asyncio.run(dataset.build_report_runner("report").run())
+        :param output_dir: where the figures go, no figures if None
+        :param formats: figure formats
+        :param max_workers: thread pool size
+        :param process_workers: process pool size
+        :return: AsyncTaskRunner
+        """
+        runner = AsyncTaskRunner(max_workers, process_workers)
+        runner.add("shape", self.get_dataset_shape)
+        runner.add("head", self.get_head)
+        runner.add("types", self.get_types)
+        runner.add("clean", self.clean_dataset, ["shape", "head", "types"])
+        runner.add("unique_bedrooms", functools.partial(self.get_unique_values, "bedrooms"), ["clean"])
+        runner.add("max_price", functools.partial(self.get_max_value, "price"), ["clean"])
+        runner.add("correlation", self.get_correlation, ["clean"])
+        runner.add("ordered_correlations", self.get_ordered_correlations, ["correlation"])
+
+        if output_dir is not None:
+            for name in REPORT_FIGURES:
+                runner.add(f"{name}_job", functools.partial(self.get_report_job, name),
+                           ["correlation" if name == "correlation" else "clean"])
+                runner.add(f"{name}_plot", functools.partial(render_cached, output_dir=output_dir, formats=formats),
+                           [f"{name}_job"], executor="process", pass_results=True)
+        return runner
+
+
+@instrument_public_methods
+class ChunkedAirbnbDataset:
+    """
+    Out-of-core version of the AirbnbDataset statistics, for csv files bigger than memory.
+    Every method streams the csv in chunks and merges the partial results, which match the in-memory
+    methods (within floating point tolerance for the correlation).
+    """
+
+    def __init__(self, file, chunksize=100000, clean=False, instrumentation=None):
+        """
+        :param file: airbnb csv
+        :param chunksize: rows per chunk
+        :param clean: clean every chunk like clean_dataset before using it
+        :param instrumentation: Instrumentation recording every public method as a stage
+        """
+        self.file = file
+        self.chunksize = chunksize
+        self.clean = clean
+        self.instrumentation = instrumentation
+
+    def iter_chunks(self):
+        """
+        :return: generator of dataframes
+        """
+        for chunk in pd.read_csv(self.file, chunksize=self.chunksize):
+            if self.clean:
+                # Chunks are short lived, downcasting them would cost more than it saves
+                clean_frame(chunk, downcast=False)
+            yield chunk
+
+    def get_dataset_shape(self):
+        """
+        :return: Number of lines and columns
+        """
+        rows = 0
+        columns = 0
+        for chunk in self.iter_chunks():
+            rows += len(chunk)
+            columns = chunk.shape[1]
+        return rows, columns
+
+    def get_null_counts(self):
+        """
+        :return: number of null values per column
+        """
+        total = None
+        for chunk in self.iter_chunks():
+            counts = chunk.isnull().sum()
+            total = counts if total is None else total + counts
+        return total
+
+    def get_unique_values(self, column_name, approximate=False, precision=14):
+        """
+        Get different values along a column, or only their approximate number (HyperLogLog)
+        in constant memory.
+        :param column_name:
+        :param approximate:
+        :param precision: HyperLogLog precision
+        :return: array of values, or estimated number of distinct values
+        """
+        try:
+            if approximate:
+                sketch = HyperLogLog(precision)
+                for chunk in self.iter_chunks():
+                    sketch.update(chunk[column_name])
+                return sketch.count()
+
+            seen = None
+            for chunk in self.iter_chunks():
+                values = chunk[column_name]
+                if pd.api.types.is_numeric_dtype(values):
+                    # Integer chunks and float chunks (with NaN) of the same column must agree
+                    values = values.astype("float64")
+                values = pd.Series(values.unique())
+                seen = values if seen is None else pd.concat([seen, values[~values.isin(seen)]])
+            return seen.unique()
+        except KeyError:
+            # Just for logging error handling
+            print("Bad column name")
+
+    def get_max_value(self, column_name):
+        """
+        Get the max value for a column
+        :param column_name:
+        :return: max value
+        """
+        try:
+            return pd.Series([chunk[column_name].max() for chunk in self.iter_chunks()]).max()
+        except KeyError:
+            # Just for logging error handling
+            print("Bad column name")
+
+    def get_min_value_accommodation(self, column_name):
+        try:
+            # Remove accommodations with price = 0
+            partial = [chunk[chunk[column_name] != 0].min() for chunk in self.iter_chunks()]
+            return pd.DataFrame(partial).min()
+        except KeyError:
+            # Just for logging error handling
+            print("Bad column name")
+
+    def get_price_quantile_sketches(self, group_column, price_limit=None, k=200):
+        """
+        One KLL quantile sketch of the price per group, built chunk by chunk.
+        :param group_column: e.g. State or room_type
+        :param price_limit: only prices below it
+        :param k: sketch accuracy
+        :return: dict group -> KLLSketch
+        """
+        sketches = {}
+        for chunk in self.iter_chunks():
+            if price_limit is not None:
+                chunk = chunk[chunk.price < price_limit]
+            update_grouped_quantiles(sketches, chunk, group_column, "price", k)
+        return sketches
+
+    def get_approximate_unique_count(self, column_name, precision=14):
+        return self.get_unique_values(column_name, approximate=True, precision=precision)
+
+    def get_top_values(self, column_name, k=10, capacity=100):
+        """
+        Most frequent values of a column, heavy hitters summaries merged over the chunks.
+        :param column_name:
+        :param k:
+        :param capacity: counters kept
+        :return: list of (value, count)
+        """
+        try:
+            sketch = HeavyHitters(capacity)
+            for chunk in self.iter_chunks():
+                sketch.update(chunk[column_name])
+            return sketch.top(k)
+        except KeyError:
+            # Just for logging error handling
+            print("Bad column name")
+
+    def get_correlation(self):
+        """
+        Pearson correlation merged over the chunks (see CorrelationEngine).
+        :return: correlation matrix
+        """
+        engine = None
+        for chunk in self.iter_chunks():
+            if engine is None:
+                engine = CorrelationEngine(numeric_columns(chunk))
+            engine.update(chunk)
+        return engine.correlation()
 
 
 if __name__ == '__main__':
-    file_path = "/home/joaocps/Koodoo/Koodoo_Data_Intern/"
-    file_name = "airbnb_dataset.csv"
+    set_display_options()
+
+    # Airbnb csv path, the cli (cli.py airbnb profile / plot) runs the same steps with options
+    csv_file = sys.argv[1] if len(sys.argv) > 1 else "airbnb_dataset.csv"
 
     # Creation of object only one time to posterior analyze
-    dataset = AirbnbDataset(file_path + file_name)
+    dataset = AirbnbDataset(csv_file)
 
     # Get number of rows and columns - (158284, 16)
     print(dataset.get_dataset_shape())
@@ -0,0 +1,167 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Memory efficient encodings of categorical features and categorical association (Cramér's V).
+https://towardsdatascience.com/the-search-for-categorical-correlation-a1cf7f1888c9
+"""
+
+import numpy as np
+import pandas as pd
+
+from lazy_import import is_available, lazy_import
+from sketches import hash_values
+
+sparse = lazy_import("scipy.sparse")
+
+
+def _require_scipy():
+    if not is_available("scipy"):
+        raise ImportError("scipy is required for the CSR encodings")
+
+
+class CategoricalEncoder:
+    """
+    Learns the vocabulary of each categorical column once and reuses it for every later batch,
+    so codes and one-hot columns stay the same across batches. New values seen by partial_fit are
+    appended to the vocabulary, existing codes never move.
+    """
+
+    def __init__(self):
+        self.vocabularies = {}
+
+    def partial_fit(self, frame, columns):
+        """
+        Learn (or extend) the vocabularies of columns.
+        :param frame:
+        :param columns:
+        :return: self
+        """
+        for column in columns:
+            values = pd.Index(frame[column].dropna().unique())
+            known = self.vocabularies.get(column)
+            if known is None:
+                self.vocabularies[column] = values
+            else:
+                self.vocabularies[column] = known.append(values[~values.isin(known)])
+        return self
+
+    def codes(self, frame, column):
+        """
+        Integer codes of a column, -1 for missing or unknown values.
+        :param frame:
+        :param column:
+        :return: int32 array
+        """
+        if column not in self.vocabularies:
+            self.partial_fit(frame, [column])
+        return self.vocabularies[column].get_indexer(frame[column]).astype(np.int32)
+
+    def one_hot_csr(self, frame, column):
+        """
+        One-hot encoding as a scipy CSR matrix, one column per vocabulary value.
+        :param frame:
+        :param column:
+        :return: (csr matrix, column names)
+        """
+        _require_scipy()
+        codes = self.codes(frame, column)
+        vocabulary = self.vocabularies[column]
+        rows = np.flatnonzero(codes >= 0)
+        matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.uint8), (rows, codes[rows])),
+                                   shape=(len(codes), len(vocabulary)))
+        return matrix, [f"{column}_{value}" for value in vocabulary]
+
+    def one_hot(self, frame, column):
+        """
+        One-hot encoding as a dataframe of SparseDtype columns, aligned with frame.
+        :param frame:
+        :param column:
+        :return: dataframe
+        """
+        categories = pd.Categorical(frame[column], categories=self.vocabularies.get(column))
+        if column not in self.vocabularies:
+            self.vocabularies[column] = categories.categories
+        return pd.get_dummies(pd.Series(categories, index=frame.index), prefix=column, sparse=True, dtype=np.uint8)
+
+    def hashed(self, frame, column, n_features=1024):
+        """
+        Feature hashing for very high cardinality columns, no vocabulary kept.
+        :param frame:
+        :param column:
+        :param n_features: width of the encoding
+        :return: scipy CSR matrix (rows x n_features)
+        """
+        _require_scipy()
+        present = frame[column].notna().to_numpy()
+        rows = np.flatnonzero(present)
+        features = (hash_values(frame[column][present]) % np.uint64(n_features)).astype(np.int64)
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.uint8), (rows, features)),
+                                 shape=(len(frame), n_features))
+
+
+def contingency_table(x, y):
+    """
+    Counts of every (x, y) pair of values, rows with a missing value skipped.
+    :param x: series
+    :param y: series
+    :return: 2d int array
+    """
+    # Factorized after the rows with a missing value are dropped, so every value counted has a row (or
+    # column) with at least one pair, an empty one would make expected counts of 0 in cramers_v
+    both = np.asarray(pd.notna(x)) & np.asarray(pd.notna(y))
+    x_codes, _ = pd.factorize(np.asarray(x)[both])
+    y_codes, _ = pd.factorize(np.asarray(y)[both])
+    x_size = x_codes.max() + 1 if len(x_codes) else 0
+    y_size = y_codes.max() + 1 if len(y_codes) else 0
+    return np.bincount(x_codes * y_size + y_codes, minlength=x_size * y_size).reshape(x_size, y_size)
+
+
+def cramers_v(x, y, bias_correction=True):
+    """
+    Cramér's V association between two categorical series, from their contingency table.
+    :param x:
+    :param y:
+    :param bias_correction: Bergsma correction, as in the article above
+    :return: value in [0, 1], NaN if a series has a single value
+    """
+    table = contingency_table(x, y)
+    n = table.sum()
+    r, k = table.shape
+    if n < 2 or r < 2 or k < 2:
+        return np.nan
+
+    expected = np.outer(table.sum(axis=1), table.sum(axis=0)) / n
+    chi2 = ((table - expected) ** 2 / expected).sum()
+    phi2 = chi2 / n
+    if not bias_correction:
+        return float(np.sqrt(phi2 / min(r - 1, k - 1)))
+
+    phi2 = max(0.0, phi2 - (k - 1) * (r - 1) / (n - 1))
+    r_corrected = r - (r - 1) ** 2 / (n - 1)
+    k_corrected = k - (k - 1) ** 2 / (n - 1)
+    denominator = min(k_corrected - 1, r_corrected - 1)
+    return float(np.sqrt(phi2 / denominator)) if denominator > 0 else np.nan
+
+
+def cramers_v_matrix(frame, columns, bias_correction=True):
+    """
+    :param frame:
+    :param columns: categorical columns
+    :param bias_correction:
+    :return: symmetric dataframe of Cramér's V
+    """
+    matrix = pd.DataFrame(np.eye(len(columns)), index=columns, columns=columns)
+    for i, a in enumerate(columns):
+        for b in columns[i + 1:]:
+            matrix.loc[a, b] = matrix.loc[b, a] = cramers_v(frame[a], frame[b], bias_correction)
+    return matrix
@@ -0,0 +1,229 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Incremental correlation from running sufficient statistics.
+"""
+
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# From this number of columns, the kendall pairs are spread over a process pool
+WIDE_MATRIX = 32
+
+
+def numeric_columns(frame):
+    """
+    Columns taking part in the correlations (numbers and booleans), like DataFrame.corr.
+    :param frame:
+    :return: list of column names
+    """
+    return list(frame.select_dtypes(include=["number", "bool", "boolean"]).columns)
+
+
+class CorrelationEngine:
+    """
+    Pairwise-complete Pearson correlation kept as float64 sufficient statistics over the rows seen:
+    per column pair, the number of rows where both values exist, the sums and sums of squares of each
+    column over those rows and the cross-products. A batch of rows updates them with a few matrix
+    products (O(k²) per row, BLAS runs them on all cores) and the matrix is derived without going
+    back to the data. Engines over the same columns can be merged, so partial results from chunks
+    or processes combine exactly.
+    Values are shifted by the means of the first batch to keep the sums numerically stable.
+    """
+
+    def __init__(self, columns, shift=None):
+        """
+        :param columns: column names
+        :param shift: per column offset subtracted before accumulating, first batch means by default
+        """
+        k = len(columns)
+        self.columns = list(columns)
+        self.shift = None if shift is None else np.asarray(shift, dtype=np.float64)
+        self.n = np.zeros((k, k))
+        self.sx = np.zeros((k, k))
+        self.sxx = np.zeros((k, k))
+        self.sxy = np.zeros((k, k))
+
+    def update(self, frame):
+        """
+        Add a batch of rows.
+        :param frame: dataframe holding the engine columns
+        :return: self
+        """
+        x = frame[self.columns].to_numpy(dtype=np.float64, na_value=np.nan)
+        if self.shift is None:
+            with np.errstate(invalid="ignore"):
+                means = np.nanmean(x, axis=0) if len(x) else np.zeros(len(self.columns))
+            self.shift = np.nan_to_num(means)
+
+        x = x - self.shift
+        valid = ~np.isnan(x)
+        x = np.where(valid, x, 0.0)
+        mask = valid.astype(np.float64)
+
+        # [i, j] entries are taken over the rows where both column i and column j have a value
+        self.n += mask.T @ mask
+        self.sx += x.T @ mask
+        self.sxx += (x * x).T @ mask
+        self.sxy += x.T @ x
+        return self
+
+    def shifted(self, shift):
+        """
+        Same statistics expressed with another shift.
+        :param shift:
+        :return: new engine
+        """
+        shift = np.asarray(shift, dtype=np.float64)
+        engine = CorrelationEngine(self.columns, shift)
+        if self.shift is None:
+            return engine
+
+        d = (self.shift - shift)[:, None]
+        engine.n = self.n.copy()
+        engine.sx = self.sx + d * self.n
+        engine.sxx = self.sxx + 2 * d * self.sx + d * d * self.n
+        engine.sxy = self.sxy + d * self.sx.T + d.T * self.sx + d * d.T * self.n
+        return engine
+
+    def merge(self, other):
+        """
+        Add the statistics of another engine over the same columns.
+        :param other:
+        :return: self
+        """
+        if other.columns != self.columns:
+            raise ValueError("Cannot merge correlation engines over different columns")
+        if other.shift is None:
+            return self
+        if self.shift is None:
+            self.shift = other.shift
+        if not np.array_equal(other.shift, self.shift):
+            other = other.shifted(self.shift)
+
+        self.n += other.n
+        self.sx += other.sx
+        self.sxx += other.sxx
+        self.sxy += other.sxy
+        return self
+
+    def correlation(self):
+        """
+        :return: correlation matrix dataframe (NaN where a pair has less than 2 rows or no variance)
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            n = self.n
+            cov = self.sxy - self.sx * self.sx.T / n
+            var_x = self.sxx - self.sx * self.sx / n
+            var_y = var_x.T
+            corr = cov / np.sqrt(var_x * var_y)
+        corr[(n < 2) | (var_x <= 0) | (var_y <= 0)] = np.nan
+        np.clip(corr, -1.0, 1.0, out=corr)
+        return pd.DataFrame(corr, index=self.columns, columns=self.columns)
+
+
+def _kendall_pairs(args):
+    """
+    Process pool worker: kendall tau of a list of column pairs.
+    :param args: (values, pairs)
+    :return: list of (i, j, tau)
+    """
+    from scipy.stats import kendalltau
+
+    values, pairs = args
+    result = []
+    for i, j in pairs:
+        both = ~(np.isnan(values[:, i]) | np.isnan(values[:, j]))
+        tau = kendalltau(values[both, i], values[both, j])[0] if both.sum() > 1 else np.nan
+        result.append((i, j, tau))
+    return result
+
+
+def rank_correlation(frame, method, workers=None):
+    """
+    Rank based correlations.
+    Spearman is the Pearson engine over the column ranks. Ranks are taken per column, so with missing
+    values it can differ slightly from pandas, which re-ranks every pair.
+    Kendall goes to pandas, or to a process pool over the column pairs for wide matrices.
+    :param frame: numeric dataframe
+    :param method: "spearman" or "kendall"
+    :param workers: pool processes for kendall
+    :return: correlation matrix dataframe
+    """
+    columns = list(frame.columns)
+    if method == "spearman":
+        return CorrelationEngine(columns).update(frame.rank()).correlation()
+
+    if method != "kendall":
+        raise ValueError(f"Unknown correlation method: {method}")
+    if len(columns) < WIDE_MATRIX:
+        return frame.astype(np.float64).corr(method="kendall")
+
+    values = frame.to_numpy(dtype=np.float64, na_value=np.nan)
+    pairs = [(i, j) for i in range(len(columns)) for j in range(i + 1, len(columns))]
+    workers = workers or os.cpu_count()
+    blocks = [pairs[start::workers] for start in range(workers)]
+
+    corr = np.eye(len(columns))
+    with ProcessPoolExecutor(workers) as pool:
+        for result in pool.map(_kendall_pairs, [(values, block) for block in blocks]):
+            for i, j, tau in result:
+                corr[i, j] = corr[j, i] = tau
+    return pd.DataFrame(corr, index=columns, columns=columns)
+
+
+def correlation_pairs(matrix):
+    """
+    Every column pair of a correlation matrix once: the upper triangle without the diagonal, NaN skipped.
+    :param matrix: correlation matrix dataframe
+    :return: (first column positions, second column positions, correlations) arrays
+    """
+    values = matrix.to_numpy(dtype=np.float64)
+    rows, columns = np.triu_indices(len(values), 1)
+    pairs = values[rows, columns]
+    valid = ~np.isnan(pairs)
+    return rows[valid], columns[valid], pairs[valid]
+
+
+def top_correlation_pairs(matrix, k=10, order="absolute"):
+    """
+    The k most correlated column pairs, picked with argpartition, only the k pairs kept are sorted.
+    :param matrix: correlation matrix dataframe
+    :param k:
+    :param order: "positive", "negative" or "absolute"
+    :return: dataframe with feature_a, feature_b and correlation
+    """
+    rows, columns, pairs = correlation_pairs(matrix)
+    if order == "positive":
+        score = pairs
+    elif order == "negative":
+        score = -pairs
+    elif order == "absolute":
+        score = np.abs(pairs)
+    else:
+        raise ValueError(f"Unknown order: {order}")
+
+    k = max(0, min(k, len(pairs)))
+    top = np.argpartition(-score, k - 1)[:k] if 0 < k < len(pairs) else np.arange(k)
+    top = top[np.argsort(-score[top], kind="stable")]
+
+    names = np.asarray(matrix.columns, dtype=object)
+    return pd.DataFrame({
+        "feature_a": names[rows[top]],
+        "feature_b": names[columns[top]],
+        "correlation": pairs[top]
+    })
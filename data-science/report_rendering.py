@@ -0,0 +1,187 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Headless rendering of the Airbnb report figures.
+Jobs only hold numpy arrays and plain parameters, they are rendered on the Agg backend in a process pool
+and cached on disk by a hash of their content, so unchanged figures are not drawn again.
+"""
+
+import hashlib
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def draw_correlation(ax, values, labels):
+    """
+    Correlation matrix as a matshow with the feature names.
+    :param ax:
+    :param values: k x k array
+    :param labels: k names
+    :return:
+    """
+    ax.matshow(values)
+    ax.set_xticks(range(len(labels)))
+    ax.set_xticklabels(labels, rotation='vertical')
+    ax.set_yticks(range(len(labels)))
+    ax.set_yticklabels(labels)
+
+
+def draw_pie(ax, counts, labels, title):
+    """
+    :param ax:
+    :param counts: array of counts
+    :param labels: one label per count
+    :param title:
+    :return:
+    """
+    ax.set_title(title)
+    ax.pie(counts, labels=labels, autopct='%1.1f%%', startangle=180)
+
+
+def draw_price_boxplot(ax, boxes, title, xlabel):
+    """
+    Price box plot from precomputed statistics, every box labeled with its median.
+    :param ax:
+    :param boxes: list of dicts with label, whislo, q1, med, q3, whishi and fliers (see Axes.bxp)
+    :param title:
+    :param xlabel:
+    :return:
+    """
+    ax.set_title(title)
+    ax.bxp(boxes, positions=range(len(boxes)))
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel("price")
+
+    for position, box in enumerate(boxes):
+        y = round(box["med"], 1)
+        ax.text(
+            position,
+            y,
+            f'{y}',
+            ha='center',
+            va='center',
+            fontweight='bold',
+            size=10,
+            color='white',
+            bbox=dict(facecolor='#445A64'))
+
+
+# kind -> (drawing function, style, figure size)
+FIGURES = {
+    "correlation": (draw_correlation, "default", (10, 10)),
+    "pie": (draw_pie, "fivethirtyeight", (13, 7)),
+    "price_boxplot": (draw_price_boxplot, "classic", (13, 7))
+}
+
+
+def job_digest(job):
+    """
+    Content hash of a job: its kind, arrays and parameters.
+    :param job: dict with "kind", "name" and the drawing arguments
+    :return: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=12)
+
+    def feed(value):
+        if isinstance(value, np.ndarray):
+            digest.update(str(value.dtype).encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, dict):
+            for key in sorted(value):
+                digest.update(str(key).encode())
+                feed(value[key])
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                feed(item)
+        else:
+            digest.update(repr(value).encode())
+
+    feed({key: value for key, value in job.items() if key != "name"})
+    return digest.hexdigest()
+
+
+def render_job(job, paths):
+    """
+    Process pool worker: draw one figure on the Agg backend and save it in every requested format.
+    :param job: dict with "kind", "name" and the drawing arguments
+    :param paths: output files
+    :return: paths
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    draw, style, size = FIGURES[job["kind"]]
+    arguments = {key: value for key, value in job.items() if key not in ("kind", "name")}
+    with plt.style.context(style):
+        figure, ax = plt.subplots(figsize=size)
+        draw(ax, **arguments)
+        figure.tight_layout()
+        for path in paths:
+            figure.savefig(path)
+        plt.close(figure)
+    return paths
+
+
+def job_paths(job, output_dir, formats):
+    """
+    :param job:
+    :param output_dir:
+    :param formats:
+    :return: files <name>-<content hash>.<format> of a job
+    """
+    digest = job_digest(job)
+    return [os.path.join(output_dir, f"{job['name']}-{digest}.{extension}") for extension in formats]
+
+
+def render_cached(job, output_dir, formats=("png",)):
+    """
+    Render one job unless its files already exist, in the calling process.
+    :param job:
+    :param output_dir:
+    :param formats:
+    :return: files
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = job_paths(job, output_dir, formats)
+    if not all(os.path.exists(path) for path in paths):
+        render_job(job, paths)
+    return paths
+
+
+def render_jobs(jobs, output_dir, formats=("png",), workers=None):
+    """
+    Render figure jobs to files named <name>-<content hash>.<format>, skipping those already rendered.
+    :param jobs: list of job dicts
+    :param output_dir:
+    :param formats: e.g. ("png", "svg")
+    :param workers: pool processes
+    :return: dict name -> list of files
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    files = {}
+    pending = []
+    for job in jobs:
+        paths = job_paths(job, output_dir, formats)
+        files[job["name"]] = paths
+        if not all(os.path.exists(path) for path in paths):
+            pending.append((job, paths))
+
+    if pending:
+        with ProcessPoolExecutor(min(workers or os.cpu_count(), len(pending))) as pool:
+            for _ in pool.map(render_job, *zip(*pending)):
+                pass
+    return files
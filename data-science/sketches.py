@@ -0,0 +1,362 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Mergeable sketches for approximate statistics in constant memory.
+"""
+
+import base64
+import json
+
+import numpy as np
+import pandas as pd
+
+
+def normalize_values(values):
+    """
+    Values as a series, numbers as float64 so that 3 and 3.0 read from different chunks are the same value.
+    :param values: series or array
+    :return: series
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+        return values.astype("float64")
+    return values.astype(object)
+
+
+def hash_values(values):
+    """
+    64 bit hashes of a batch of values. Numbers are hashed as float64, so 3 and 3.0 read from
+    different chunks hash the same.
+    :param values: series or array
+    :return: uint64 array
+    """
+    return pd.util.hash_pandas_object(normalize_values(values), index=False).to_numpy(dtype=np.uint64)
+
+
+class HyperLogLog:
+    """
+    Distinct count estimate with 2^precision one byte registers (relative error about 1.04 / sqrt(2^precision)).
+    """
+
+    def __init__(self, precision=14):
+        """
+        :param precision: between 11 and 18
+        """
+        if not 11 <= precision <= 18:
+            raise ValueError("HyperLogLog precision must be between 11 and 18")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def update(self, values):
+        """
+        Add a batch of values.
+        :param values: series or array
+        :return: self
+        """
+        hashes = hash_values(values)
+        if not len(hashes):
+            return self
+
+        bits = 64 - self.precision
+        index = (hashes >> np.uint64(bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << bits) - 1)
+        # Position of the leftmost 1 bit in the remaining bits, rest < 2^53 so the float conversion is exact
+        bit_length = np.frexp(rest.astype(np.float64))[1]
+        rank = (bits - bit_length + 1).astype(np.uint8)
+
+        best = pd.Series(rank).groupby(index).max()
+        positions = best.index.to_numpy()
+        self.registers[positions] = np.maximum(self.registers[positions], best.to_numpy())
+        return self
+
+    def merge(self, other):
+        """
+        :param other: HyperLogLog with the same precision
+        :return: self
+        """
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches with different precisions")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        """
+        :return: estimated number of distinct values
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction, linear counting
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {"precision": self.precision, "registers": base64.b64encode(self.registers.tobytes()).decode()}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state["precision"])
+        sketch.registers = np.frombuffer(base64.b64decode(state["registers"]), dtype=np.uint8).copy()
+        return sketch
+
+
+class KLLSketch:
+    """
+    KLL quantile sketch: levels of sorted compactors, an item at level h stands for 2^h values.
+    Rank error is about 1.7 / k of the number of values, memory is O(k) whatever the stream length.
+    """
+
+    def __init__(self, k=200, seed=None):
+        """
+        :param k: accuracy parameter, size of the top compactor
+        :param seed: seed of the random compaction offsets
+        """
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values):
+        """
+        Add a batch of values, missing values are ignored.
+        :param values: series or array of numbers
+        :return: self
+        """
+        values = pd.Series(values, dtype="float64").dropna().to_numpy()
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+        return self
+
+    def compress(self):
+        """
+        Compact every level above its capacity: sort it, promote every other item (random offset) to
+        the next level.
+        :return:
+        """
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # An odd item stays at its level
+                kept = items[len(items) - len(items) % 2:]
+                items = items[:len(items) - len(items) % 2]
+                promoted = items[self.rng.integers(2)::2]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                self.levels[level] = kept
+            level += 1
+
+    def merge(self, other):
+        """
+        :param other: KLLSketch
+        :return: self
+        """
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.n += other.n
+        self.compress()
+        return self
+
+    def quantiles(self, probabilities):
+        """
+        :param probabilities: values in [0, 1]
+        :return: array of estimated quantiles (NaN if the sketch is empty)
+        """
+        probabilities = np.atleast_1d(np.asarray(probabilities, dtype=np.float64))
+        items = np.concatenate(self.levels)
+        if not len(items):
+            return np.full(len(probabilities), np.nan)
+
+        weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        cumulative = np.cumsum(weights[order])
+        positions = np.searchsorted(cumulative, probabilities * cumulative[-1], side="left")
+        return items[order][np.minimum(positions, len(items) - 1)]
+
+    def quantile(self, probability):
+        return float(self.quantiles([probability])[0])
+
+    def to_dict(self):
+        return {"k": self.k, "n": self.n, "levels": [items.tolist() for items in self.levels]}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state["k"])
+        sketch.n = state["n"]
+        sketch.levels = [np.asarray(items, dtype=np.float64) for items in state["levels"]]
+        return sketch
+
+
+class CountMinSketch:
+    """
+    Frequency estimates in a depth x width table of counters, never below the true count and above it
+    by at most 2n / width with probability 1 - 2^-depth.
+    """
+
+    def __init__(self, width=2048, depth=5):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def columns(self, values):
+        """
+        Counter of each value in every row, double hashing from the two halves of the 64 bit hash.
+        :param values:
+        :return: (depth, len(values)) array
+        """
+        hashes = hash_values(values)
+        low = hashes & np.uint64(0xFFFFFFFF)
+        high = hashes >> np.uint64(32)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((low + rows * high) % np.uint64(self.width)).astype(np.int64)
+
+    def update(self, values):
+        """
+        :param values: series or array
+        :return: self
+        """
+        for row, columns in enumerate(self.columns(values)):
+            self.table[row] += np.bincount(columns, minlength=self.width)
+        return self
+
+    def estimate(self, values):
+        """
+        :param values: series or array
+        :return: array of estimated counts
+        """
+        columns = self.columns(values)
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("Cannot merge Count-Min sketches with different shapes")
+        self.table += other.table
+        return self
+
+    def to_dict(self):
+        return {"width": self.width, "depth": self.depth, "table": self.table.tolist()}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state["width"], state["depth"])
+        sketch.table = np.asarray(state["table"], dtype=np.int64)
+        return sketch
+
+
+class HeavyHitters:
+    """
+    Top-k values with at most `capacity` counters: a Misra-Gries summary, the mergeable counterpart of
+    space-saving. Every value more frequent than n / (capacity + 1) is kept, and counts are
+    underestimated by at most that much.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype="int64")
+        self.n = 0
+
+    def reduce(self, counts):
+        """
+        Keep at most capacity counters, lowering all of them by the first count dropped.
+        :param counts: series value -> count
+        :return:
+        """
+        counts = counts.sort_values(ascending=False, kind="stable")
+        if len(counts) > self.capacity:
+            counts = counts.iloc[:self.capacity] - counts.iloc[self.capacity]
+            counts = counts[counts > 0]
+        self.counts = counts
+
+    def update(self, values):
+        """
+        :param values: series or array
+        :return: self
+        """
+        values = normalize_values(values)
+        self.n += len(values)
+        self.reduce(self.counts.add(values.value_counts(dropna=False), fill_value=0).astype("int64"))
+        return self
+
+    def merge(self, other):
+        self.n += other.n
+        self.reduce(self.counts.add(other.counts, fill_value=0).astype("int64"))
+        return self
+
+    def top(self, k=10):
+        """
+        :param k:
+        :return: list of (value, estimated count), most frequent first
+        """
+        return list(self.counts.iloc[:k].items())
+
+    def to_dict(self):
+        return {"capacity": self.capacity, "n": self.n,
+                "counts": [[value, int(count)] for value, count in self.counts.items()]}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state["capacity"])
+        sketch.n = state["n"]
+        if state["counts"]:
+            values, counts = zip(*state["counts"])
+            sketch.counts = pd.Series(counts, index=pd.Index(values, dtype=object), dtype="int64")
+        return sketch
+
+
+SKETCH_TYPES = {cls.__name__: cls for cls in (HyperLogLog, KLLSketch, CountMinSketch, HeavyHitters)}
+
+
+def update_grouped_quantiles(sketches, frame, group_column, value_column, k=200):
+    """
+    Add the values of a frame to one KLL sketch per group.
+    :param sketches: dict group -> KLLSketch, updated in place
+    :param frame:
+    :param group_column:
+    :param value_column:
+    :param k: accuracy of new sketches
+    :return: sketches
+    """
+    for group, values in frame.groupby(group_column, observed=True)[value_column]:
+        sketches.setdefault(group, KLLSketch(k)).update(values)
+    return sketches
+
+
+def save_sketches(sketches, path):
+    """
+    Save a dict of sketches (e.g. one per group or per daily partition) to json.
+    :param sketches: dict key -> sketch
+    :param path:
+    :return:
+    """
+    with open(path, "w") as f:
+        json.dump([[key, type(sketch).__name__, sketch.to_dict()] for key, sketch in sketches.items()], f)
+
+
+def load_sketches(path):
+    """
+    :param path: file written by save_sketches
+    :return: dict key -> sketch
+    """
+    with open(path) as f:
+        return {key: SKETCH_TYPES[name].from_dict(state) for key, name, state in json.load(f)}
@@ -0,0 +1,119 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Asyncio task runner over a dependency graph: every task starts as soon as its dependencies are done,
+on a thread pool or a process pool, so the run takes the time of the critical path.
+"""
+
+import asyncio
+import functools
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# function: callable, given the results of the dependencies (in order) when pass_results is set
+# executor: "thread" or "process" (function and results must then be picklable)
+Task = namedtuple("Task", ["name", "function", "dependencies", "executor", "pass_results"])
+
+
+class AsyncTaskRunner:
+
+    def __init__(self, max_workers=None, process_workers=None):
+        """
+        :param max_workers: thread pool size
+        :param process_workers: process pool size, the pool is only started if a task needs it
+        """
+        self.max_workers = max_workers
+        self.process_workers = process_workers
+        self.graph = {}
+        self.futures = {}
+
+    def add(self, name, function, dependencies=(), executor="thread", pass_results=False):
+        """
+        Add a task to the graph.
+        :param name:
+        :param function:
+        :param dependencies: names of the tasks to wait for
+        :param executor: "thread" or "process"
+        :param pass_results: call function with the dependency results
+        :return: self
+        """
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown executor: {executor}")
+        self.graph[name] = Task(name, function, tuple(dependencies), executor, pass_results)
+        return self
+
+    def order(self, names=None):
+        """
+        Tasks needed for names (all by default), dependencies first.
+        :param names:
+        :return: list of task names
+        """
+        ordered = []
+        state = {}
+
+        def visit(name, path):
+            if name not in self.graph:
+                raise ValueError(f"Unknown task: {name}")
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"Dependency cycle: {' -> '.join(path + [name])}")
+            state[name] = "visiting"
+            for dependency in self.graph[name].dependencies:
+                visit(dependency, path + [name])
+            state[name] = "done"
+            ordered.append(name)
+
+        for name in names or self.graph:
+            visit(name, [])
+        return ordered
+
+    async def run(self, names=None):
+        """
+        Run the tasks (and their dependencies), each one awaitable in self.futures while running.
+        :param names: tasks wanted, all by default
+        :return: dict name -> result
+        """
+        loop = asyncio.get_running_loop()
+        ordered = self.order(names)
+        needs_processes = any(self.graph[name].executor == "process" for name in ordered)
+
+        threads = ThreadPoolExecutor(self.max_workers)
+        processes = ProcessPoolExecutor(self.process_workers) if needs_processes else None
+        try:
+            async def execute(task):
+                results = [await self.futures[dependency] for dependency in task.dependencies]
+                function = task.function
+                if task.pass_results:
+                    function = functools.partial(function, *results)
+                pool = processes if task.executor == "process" else threads
+                return await loop.run_in_executor(pool, function)
+
+            self.futures = {}
+            for name in ordered:
+                self.futures[name] = asyncio.ensure_future(execute(self.graph[name]))
+            values = await asyncio.gather(*self.futures.values())
+            return dict(zip(self.futures, values))
+        finally:
+            threads.shutdown(wait=False)
+            if processes is not None:
+                processes.shutdown(wait=False)
+
+    async def result(self, name):
+        """
+        Await the result of a task of the current run.
+        :param name:
+        :return: task result
+        """
+        return await self.futures[name]
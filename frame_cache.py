@@ -0,0 +1,163 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+On-disk cache of parsed csv files, shared by WinesDataset and AirbnbDataset.
+Frames are stored as Arrow IPC (feather) files and memory-mapped on load, keyed by the content hash of
+the source and of the cleaning rules. Without pyarrow, pickle is used instead.
+"""
+
+import hashlib
+import json
+import os
+
+from lazy_import import is_available, lazy_import
+
+pd = lazy_import("pandas")
+pa = lazy_import("pyarrow")
+feather = lazy_import("pyarrow.feather")
+ARROW = is_available("pyarrow")
+
+# Default size bound of a cache directory
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Arrow schema metadata key holding the DataFrame.attrs of a cached frame
+ATTRS_KEY = b"frame_attrs"
+
+
+class FrameCache:
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param directory: cache directory, created if needed
+        :param max_bytes: size bound, least recently used entries are evicted above it
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(directory, "index.json")
+        os.makedirs(directory, exist_ok=True)
+
+    def file_digest(self, source):
+        """
+        Content hash of a file. Hashing a big csv still costs a full read, so the digest is remembered
+        for the (path, size, mtime) of the file.
+        :param source:
+        :return: hex digest
+        """
+        stat = os.stat(source)
+        signature = f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+        index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                index = json.load(f)
+        if signature in index:
+            return index[signature]
+
+        digest = hashlib.blake2b(digest_size=16)
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+
+        index[signature] = digest.hexdigest()
+        with open(self.index_file, "w") as f:
+            json.dump(index, f)
+        return index[signature]
+
+    def path(self, source, rules):
+        """
+        Cache entry of a source file parsed with a set of rules.
+        :param source:
+        :param rules: text describing the parsing and cleaning, any change invalidates the entry
+        :return: path
+        """
+        rules_digest = hashlib.blake2b(rules.encode(), digest_size=8).hexdigest()
+        extension = "arrow" if ARROW else "pkl"
+        return os.path.join(self.directory, f"{self.file_digest(source)}-{rules_digest}.{extension}")
+
+    def load(self, source, rules):
+        """
+        :param source:
+        :param rules:
+        :return: cached dataframe (with the attrs it was stored with), None on a miss
+        """
+        path = self.path(source, rules)
+        if not os.path.exists(path):
+            return None
+        # Touch the entry, eviction is least recently used first
+        os.utime(path)
+        if ARROW:
+            table = feather.read_table(path, memory_map=True)
+            frame = table.to_pandas()
+            attrs = (table.schema.metadata or {}).get(ATTRS_KEY)
+            if attrs is not None:
+                frame.attrs = json.loads(attrs)
+            return frame
+        return pd.read_pickle(path)
+
+    def store(self, source, rules, frame):
+        """
+        Write a frame to the cache and evict old entries above the size bound.
+        :param source:
+        :param rules:
+        :param frame: dataframe with a default index, its attrs (json serializable) are stored with it
+        :return:
+        """
+        path = self.path(source, rules)
+        tmp = path + ".tmp"
+        if ARROW:
+            table = pa.Table.from_pandas(frame)
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                   ATTRS_KEY: json.dumps(frame.attrs).encode()})
+            # Uncompressed, so the columns can be memory-mapped
+            feather.write_feather(table, tmp, compression="uncompressed")
+        else:
+            frame.to_pickle(tmp)
+        os.replace(tmp, path)
+        self.evict(keep=os.path.basename(path))
+
+    def get_or_parse(self, source, rules, parse):
+        """
+        :param source:
+        :param rules:
+        :param parse: callable building the frame on a miss
+        :return: dataframe
+        """
+        frame = self.load(source, rules)
+        if frame is None:
+            frame = parse()
+            self.store(source, rules, frame)
+        return frame
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        :param keep: entry never removed (the one just written)
+        :return: list of removed files
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith((".arrow", ".pkl")):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        removed = []
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+            removed.append(name)
+        return removed
@@ -0,0 +1,265 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Per stage instrumentation shared by WinesDataset and AirbnbDataset.
+Every public method is a stage: wall time, rows in and out, peak memory and SQLite statements are
+recorded and sent to pluggable sinks. cProfile and tracemalloc captures can be switched on per stage.
+"""
+
+import cProfile
+import functools
+import inspect
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+from collections import defaultdict
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the process (ru_maxrss is in KB on linux, bytes on macOS).
+    :return: MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def count_rows(value):
+    """
+    Rows of a stage input or output: length of frames, series and lists, or an int row count.
+    :param value:
+    :return: number of rows or None
+    """
+    if isinstance(value, bool) or value is None or isinstance(value, (str, tuple)):
+        return None
+    if isinstance(value, int):
+        return value
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+class MetricsRegistry:
+    """
+    In-process sink, keeps every stage record.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def summary(self):
+        """
+        Calls, total and max seconds, and SQLite statements per stage.
+        :return: dict stage -> dict
+        """
+        stages = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "sql_statements": 0})
+        for record in self.records:
+            stage = stages[record["stage"]]
+            stage["calls"] += 1
+            stage["seconds"] += record["seconds"]
+            stage["max_seconds"] = max(stage["max_seconds"], record["seconds"])
+            stage["sql_statements"] += record["sql_statements"]
+        return dict(stages)
+
+
+class JsonLogSink:
+    """
+    Sink appending one json line per stage record to a file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+class Instrumentation:
+    """
+    Collects the stage records. Stages can nest, SQLite statements are attributed to the innermost one
+    of the thread running them: every thread has its own stack of stages.
+    """
+
+    def __init__(self, sinks=None, profile_stages=(), trace_memory_stages=(), profile_dir="."):
+        """
+        :param sinks: objects with an emit(record) method, a MetricsRegistry by default
+        :param profile_stages: stage names (or "*") captured with cProfile, dumped to profile_dir
+        :param trace_memory_stages: stage names (or "*") whose python allocations are traced with tracemalloc
+        :param profile_dir:
+        """
+        self.sinks = sinks if sinks is not None else [MetricsRegistry()]
+        self.profile_stages = set(profile_stages)
+        self.trace_memory_stages = set(trace_memory_stages)
+        self.profile_dir = profile_dir
+        self.local = threading.local()
+        self.connections = set()
+
+    @property
+    def stack(self):
+        """
+        Stages running in the current thread, innermost last.
+        :return: list of stage frames
+        """
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def watch(self, conn):
+        """
+        Count and time the statements of a SQLite connection through its trace callback.
+        :param conn: sqlite3 connection (ignored if None or already watched)
+        :return:
+        """
+        if conn is not None and id(conn) not in self.connections:
+            conn.set_trace_callback(self.on_statement)
+            self.connections.add(id(conn))
+
+    def on_statement(self, statement):
+        """
+        Trace callback: a statement starts, which ends the previous one of the current stage.
+        :param statement:
+        :return:
+        """
+        stack = self.stack
+        if stack:
+            self.close_statement(stack[-1])
+            stack[-1]["current"] = (statement, time.perf_counter())
+
+    @staticmethod
+    def close_statement(frame):
+        if frame["current"] is not None:
+            statement, start = frame["current"]
+            seconds = time.perf_counter() - start
+            frame["statements"] += 1
+            frame["sql_seconds"] += seconds
+            frame["slowest"] = sorted(frame["slowest"] + [(seconds, statement[:200])], reverse=True)[:5]
+            frame["current"] = None
+
+    def record_error(self, error):
+        """
+        Mark the innermost stage of the current thread as failed with an error it caught and handled
+        itself (the stage still returns normally).
+        :param error: exception
+        :return:
+        """
+        stack = self.stack
+        if stack:
+            stack[-1]["errors"].append(repr(error))
+
+    def wanted(self, stages, stage):
+        return "*" in stages or stage in stages
+
+    def run(self, stage, function, rows_in=None, rows_after=None):
+        """
+        Run a function as a stage and emit its record.
+        :param stage: stage name
+        :param function: callable without arguments
+        :param rows_in: rows given to the stage
+        :param rows_after: callable giving the rows after the stage, when the return value has none
+        :return: function return value
+        """
+        frame = {"statements": 0, "sql_seconds": 0.0, "slowest": [], "current": None, "errors": []}
+        self.stack.append(frame)
+
+        profiler = cProfile.Profile() if self.wanted(self.profile_stages, stage) else None
+        tracing = self.wanted(self.trace_memory_stages, stage) and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+
+        status = "ok"
+        result = None
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                result = profiler.runcall(function)
+            else:
+                result = function()
+            return result
+        except Exception as e:
+            status = f"error: {e!r}"
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.close_statement(frame)
+            self.stack.pop()
+            if status == "ok" and frame["errors"]:
+                status = f"error: {frame['errors'][-1]}"
+
+            rows_out = count_rows(result)
+            if rows_out is None and rows_after is not None:
+                rows_out = rows_after()
+
+            record = {
+                "stage": stage,
+                "status": status,
+                "started": time.time() - seconds,
+                "seconds": seconds,
+                "rows_in": rows_in,
+                "rows_out": rows_out,
+                "peak_rss_mb": peak_rss_mb(),
+                "sql_statements": frame["statements"],
+                "sql_seconds": frame["sql_seconds"],
+                "slowest_sql": frame["slowest"],
+                "errors": frame["errors"]
+            }
+            if tracing:
+                record["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                tracemalloc.stop()
+            if profiler is not None:
+                path = os.path.join(self.profile_dir, f"{stage}-{int(time.time() * 1000)}.prof")
+                profiler.dump_stats(path)
+                record["profile"] = path
+
+            for sink in self.sinks:
+                sink.emit(record)
+
+
+def instrument_public_methods(cls):
+    """
+    Class decorator: every public method becomes a stage of the instance's "instrumentation" attribute.
+    With no instrumentation set the methods run untouched. Generators are left alone, their work happens
+    while they are consumed.
+    :param cls:
+    :return: cls
+    """
+    def wrap(name, method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            instrumentation = getattr(self, "instrumentation", None)
+            if instrumentation is None:
+                return method(self, *args, **kwargs)
+
+            instrumentation.watch(getattr(self, "conn", None))
+            data = getattr(self, "data", None)
+            return instrumentation.run(f"{cls.__name__}.{name}",
+                                       lambda: method(self, *args, **kwargs),
+                                       rows_in=count_rows(data),
+                                       rows_after=lambda: count_rows(getattr(self, "data", None)))
+        return wrapper
+
+    for name, member in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.isfunction(member) or inspect.isgeneratorfunction(member):
+            continue
+        setattr(cls, name, wrap(name, member))
+    return cls
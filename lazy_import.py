@@ -0,0 +1,51 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Deferred imports of the heavy libraries (pandas, pyarrow, matplotlib, seaborn), so the commands that
+do not use them start without paying for their import.
+"""
+
+import importlib
+import importlib.util
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stands for a module until one of its attributes is used, then imports it and delegates to it.
+    Unlike importlib.util.LazyLoader it also defers dotted names: LazyLoader needs the spec of
+    matplotlib.pyplot, which imports matplotlib at once.
+    """
+
+    def __getattr__(self, attribute):
+        return getattr(importlib.import_module(self.__name__), attribute)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_import(name):
+    """
+    :param name: module name, e.g. "pandas" or "matplotlib.pyplot"
+    :return: module imported on first use
+    """
+    return LazyModule(name)
+
+
+def is_available(name):
+    """
+    Whether an optional top level package is installed, without importing it.
+    :param name:
+    :return: bool
+    """
+    return importlib.util.find_spec(name) is not None
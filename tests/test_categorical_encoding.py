@@ -0,0 +1,54 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Contingency tables and Cramér's V with missing values.
+
+python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "data-science"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from categorical_encoding import contingency_table, cramers_v
+
+
+class MissingValuesTest(unittest.TestCase):
+
+    def setUp(self):
+        # "a" only appears next to a missing y, it must not leave an empty row in the table
+        self.x = pd.Series(["a", "b", "c", "b", "c", "b", "c"])
+        self.y = pd.Series([None, "u", "v", "u", "v", "v", "u"])
+
+    def test_contingency_table_skips_values_only_seen_with_missing(self):
+        np.testing.assert_array_equal(contingency_table(self.x, self.y), [[2, 1], [1, 2]])
+
+    def test_cramers_v_same_as_on_complete_rows(self):
+        self.assertAlmostEqual(cramers_v(self.x, self.y, bias_correction=False), 1 / 3)
+        self.assertEqual(cramers_v(self.x, self.y), cramers_v(self.x[1:], self.y[1:]))
+        self.assertFalse(np.isnan(cramers_v(self.x, self.y)))
+
+    def test_categorical_series(self):
+        x = self.x.astype("category")
+        y = self.y.astype("category")
+        self.assertAlmostEqual(cramers_v(x, y, bias_correction=False), 1 / 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
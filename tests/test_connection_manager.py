@@ -0,0 +1,85 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Readers and writer of the ConnectionManager, used from several threads.
+
+python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "data-engineering"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import wines_dataset_jcps as wines
+from connection_manager import ConnectionManager
+
+ROWS = 2000
+
+
+class ConnectionManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.directory.name, "wines.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_nested_reads_keep_the_reader(self):
+        with ConnectionManager(self.db, readers=1) as manager:
+            with manager.write() as conn:
+                conn.execute("CREATE TABLE t (x)")
+            with manager.read() as outer:
+                with manager.read() as inner:
+                    self.assertIs(inner, outer)
+                # The outer block still holds the reader
+                self.assertEqual(manager.idle.qsize(), 0)
+            self.assertEqual(manager.idle.qsize(), 1)
+
+    def test_concurrent_loads_do_not_mix_transactions(self):
+        csv_file = os.path.join(self.directory.name, "wines.csv")
+        with open(csv_file, "w") as f:
+            f.write("vintage,country,county,designation,points,Price,province,title,variety,winery\n")
+            for i in range(ROWS):
+                f.write(f"2012,Italy,Napa,d,88,${i % 90 + 10},Tuscany,t{i},Pinot,W{i % 7}\n")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            dataset = wines.WinesDataset(csv_file, chunksize=100)
+            dataset.create_db_connection(self.db)
+            for table in [wines.sql_create_staging_wines_table] + wines.STAR_SCHEMA_TABLES:
+                dataset.create_db_table(table)
+
+            threads = [threading.Thread(target=dataset.load_csv_in_chunks, args=("staging_wines",)),
+                       threading.Thread(target=dataset.bulk_load_csv_into_table, args=("staging_wines", 100)),
+                       threading.Thread(target=dataset.refresh_star_schema)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            dataset.refresh_star_schema()
+
+        conn = dataset.conn
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM staging_wines").fetchone(), (2 * ROWS,))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM factwine").fetchone(), (2 * ROWS,))
+        dataset.close_db_connection()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Stage records of an instrumented WinesDataset.
+
+python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "data-engineering"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import wines_dataset_jcps as wines
+from instrumentation import Instrumentation
+
+
+class StageStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.instrumentation = Instrumentation()
+        self.dataset = wines.WinesDataset(None, instrumentation=self.instrumentation)
+        self.dataset.create_db_connection(os.path.join(self.directory.name, "wines.db"))
+
+    def tearDown(self):
+        self.dataset.close_db_connection()
+        self.directory.cleanup()
+
+    def test_handled_database_error_fails_the_stage(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.dataset.create_db_table("CREATE TABLE broken (")
+        self.dataset.create_db_table(wines.sql_create_staging_wines_table)
+
+        broken, created = [record for record in self.instrumentation.sinks[0].records
+                           if record["stage"] == "WinesDataset.create_db_table"]
+        self.assertTrue(broken["status"].startswith("error: OperationalError"))
+        self.assertEqual(len(broken["errors"]), 1)
+        self.assertEqual(created["status"], "ok")
+        self.assertEqual(created["errors"], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Incremental refresh of the star schema from staging_wines: every staging batch reaches factwine exactly
+once, also when the staging table is emptied and reloaded between refreshes.
+
+python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "data-engineering"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import wines_dataset_jcps as wines
+
+CSV = """vintage,country,county,designation,points,Price,province,title,variety,winery
+2012,Italy,Napa,d,88,$48.50,Bordeaux,t0,Pinot,W4
+2014,US,Napa,d,95,$121,Bordeaux,t1,Pinot,W1
+2015,US,Sonoma,d,90,$15.99,Oregon,t2,Merlot,W2
+2012,France,,d,85,"$1,200",Bordeaux,t3,Merlot,W3
+2016,Italy,Napa,d,92,$60,Tuscany,t4,Syrah,W4
+2013,Spain,,d,87,,Rioja,t5,Tempranillo,W5
+2014,US,Sonoma,d,91,$35,Oregon,t6,Pinot,W2
+2015,France,,d,89,$22.50,Bordeaux,t7,Syrah,W3
+"""
+
+# staging_wines as created before it had a staging_id, rowids are reused once the table is emptied
+sql_create_legacy_staging_wines_table = """CREATE TABLE staging_wines (
+vintage TEXT, country TEXT, county TEXT, designation TEXT, points INTEGER, price REAL,
+province TEXT, title TEXT, variety TEXT, winery TEXT)
+"""
+
+
+class StarSchemaRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.csv_file = os.path.join(self.directory.name, "wines.csv")
+        with open(self.csv_file, "w") as f:
+            f.write(CSV)
+        self.small_csv_file = os.path.join(self.directory.name, "small.csv")
+        with open(self.small_csv_file, "w") as f:
+            f.write("".join(CSV.splitlines(keepends=True)[:4]))
+
+    def tearDown(self):
+        self.dataset.close_db_connection()
+        self.directory.cleanup()
+
+    def quiet(self, function, *args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function(*args)
+
+    def create_database(self, staging_table=wines.sql_create_staging_wines_table):
+        self.dataset = self.quiet(wines.WinesDataset, None)
+        self.quiet(self.dataset.create_db_connection, os.path.join(self.directory.name, "wines.db"))
+        for table in [staging_table] + wines.STAR_SCHEMA_TABLES:
+            self.quiet(self.dataset.create_db_table, table)
+
+    def load(self, csv_file):
+        self.dataset.file = csv_file
+        self.dataset.data = self.quiet(self.dataset.read_csv)
+        self.quiet(self.dataset.get_csv_data_types)
+        self.quiet(self.dataset.load_csv_into_table, "staging_wines")
+
+    def fact_rows(self):
+        return self.dataset.conn.execute("SELECT COUNT(*) FROM factwine").fetchone()[0]
+
+    def truncate_staging(self):
+        with self.dataset.conn:
+            self.dataset.conn.execute("DELETE FROM staging_wines")
+
+    def test_refresh_is_idempotent(self):
+        self.create_database()
+        self.load(self.csv_file)
+        self.assertEqual(self.quiet(self.dataset.refresh_star_schema), 8)
+        self.assertEqual(self.quiet(self.dataset.refresh_star_schema), 0)
+        self.assertEqual(self.fact_rows(), 8)
+
+    def test_truncate_and_reload_smaller_batch(self):
+        self.create_database()
+        self.load(self.csv_file)
+        self.quiet(self.dataset.refresh_star_schema)
+
+        self.truncate_staging()
+        self.load(self.small_csv_file)
+        self.assertEqual(self.quiet(self.dataset.refresh_star_schema), 3)
+        self.assertEqual(self.fact_rows(), 11)
+
+    def test_truncate_and_reload_larger_batch(self):
+        self.create_database()
+        self.load(self.small_csv_file)
+        self.quiet(self.dataset.refresh_star_schema)
+
+        self.truncate_staging()
+        self.load(self.csv_file)
+        self.assertEqual(self.quiet(self.dataset.refresh_star_schema), 8)
+        self.assertEqual(self.fact_rows(), 11)
+
+    def test_cached_population_moves_the_mark(self):
+        self.create_database()
+        self.load(self.csv_file)
+        self.quiet(self.dataset.populate_dim_tables)
+        self.assertEqual(self.quiet(self.dataset.populate_fact_table_cached), 8)
+        self.assertEqual(self.quiet(self.dataset.populate_fact_table_cached), 0)
+        self.assertEqual(self.quiet(self.dataset.refresh_star_schema), 0)
+        self.assertEqual(self.fact_rows(), 8)
+
+        self.load(self.small_csv_file)
+        self.assertEqual(self.quiet(self.dataset.populate_fact_table_cached), 3)
+        self.assertEqual(self.fact_rows(), 11)
+
+    def test_truncate_and_reload_legacy_staging_table(self):
+        self.create_database(sql_create_legacy_staging_wines_table)
+        self.load(self.csv_file)
+        self.quiet(self.dataset.refresh_star_schema)
+
+        self.truncate_staging()
+        self.load(self.small_csv_file)
+        self.assertEqual(self.quiet(self.dataset.refresh_star_schema), 3)
+        self.assertEqual(self.fact_rows(), 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+Copyright (C) 2021 João Santos
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Freshness of the materialized summaries of the wines database: deletes and updates of the source rows
+must never be answered from a stale summary.
+
+python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "data-engineering"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import wines_dataset_jcps as wines
+
+CSV = """vintage,country,county,designation,points,Price,province,title,variety,winery
+2012,Italy,Napa,d,88,$48.50,Bordeaux,t0,Pinot,W4
+2014,US,Napa,d,95,$121,Bordeaux,t1,Pinot,W1
+2015,US,Sonoma,d,90,$15.99,Oregon,t2,Merlot,W2
+2012,France,,d,85,"$1,200",Bordeaux,t3,Merlot,W3
+2016,Italy,Napa,d,92,$60,Tuscany,t4,Syrah,W4
+2013,Spain,,d,87,,Rioja,t5,Tempranillo,W5
+2014,US,Sonoma,d,91,$35,Oregon,t6,Pinot,W2
+2015,France,,d,89,$22.50,Bordeaux,t7,Syrah,W3
+"""
+
+
+class SummaryFreshnessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        csv_file = os.path.join(self.directory.name, "wines.csv")
+        with open(csv_file, "w") as f:
+            f.write(CSV)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.dataset = wines.WinesDataset(csv_file)
+            self.dataset.create_db_connection(os.path.join(self.directory.name, "wines.db"))
+            for table in [wines.sql_create_staging_wines_table] + wines.STAR_SCHEMA_TABLES:
+                self.dataset.create_db_table(table)
+            self.dataset.get_csv_data_types()
+            self.dataset.load_csv_into_table("staging_wines")
+            self.dataset.refresh_star_schema()
+        self.conn = self.dataset.conn
+
+    def tearDown(self):
+        self.dataset.close_db_connection()
+        self.directory.cleanup()
+
+    def quiet(self, function, *args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function(*args)
+
+    def scan_price_info(self, table):
+        return self.conn.execute(f"SELECT COUNT(price), AVG(price), MIN(price), MAX(price) FROM {table}").fetchone()
+
+    def test_summaries_used_after_load(self):
+        self.assertIsNotNone(self.dataset.get_summary())
+        self.assertEqual(self.quiet(self.dataset.count_total_table_rows_sw), (8,))
+        self.assertEqual(tuple(self.quiet(self.dataset.get_price_info))[1:], self.scan_price_info("staging_wines"))
+
+    def test_delete_from_the_middle_of_staging(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM staging_wines WHERE rowid IN (2, 3, 4)")
+
+        # MAX(rowid) did not move, the summary must still be seen as stale
+        self.assertEqual(self.quiet(self.dataset.count_total_table_rows_sw), (5,))
+        self.assertEqual(tuple(self.quiet(self.dataset.get_price_info))[1:], self.scan_price_info("staging_wines"))
+
+        self.quiet(self.dataset.refresh_summary_tables)
+        self.assertEqual(self.quiet(self.dataset.count_total_table_rows_sw), (5,))
+        self.assertEqual(tuple(self.quiet(self.dataset.get_price_info))[1:], self.scan_price_info("staging_wines"))
+
+    def test_update_of_fact_prices(self):
+        with self.conn:
+            self.conn.execute("UPDATE factwine SET price = price * 2 WHERE wine_id = 3")
+
+        self.assertIsNone(self.dataset.get_summary())
+        self.assertEqual(tuple(self.dataset.get_price_stats())[1:], self.scan_price_info("factwine"))
+
+        self.quiet(self.dataset.refresh_summary_tables)
+        self.assertIsNotNone(self.dataset.get_summary())
+        self.assertEqual(tuple(self.dataset.get_price_stats())[1:], self.scan_price_info("factwine"))
+
+    def test_update_of_a_dimension(self):
+        with self.conn:
+            self.conn.execute("UPDATE dimvariety SET variety = 'Pinot Noir' WHERE variety = 'Pinot'")
+
+        self.assertIsNone(self.dataset.get_summary("variety"))
+        self.assertIsNotNone(self.dataset.get_summary("country"))
+
+        self.quiet(self.dataset.refresh_summary_tables)
+        groups = [row.group for row in self.dataset.get_summary("variety")]
+        self.assertIn("Pinot Noir", groups)
+        self.assertNotIn("Pinot", groups)
+
+    def test_table_created_again(self):
+        with self.conn:
+            self.conn.execute("DROP TABLE staging_wines")
+            self.conn.execute(wines.sql_create_staging_wines_table)
+        self.quiet(self.dataset.load_csv_into_table, "staging_wines")
+        self.quiet(self.dataset.load_csv_into_table, "staging_wines")
+
+        # The new table has no change triggers yet, its summary was rebuilt rather than added to
+        self.assertEqual(self.conn.execute("SELECT rows FROM summary_staging_wines").fetchone(), (16,))
+        self.assertEqual(self.quiet(self.dataset.count_total_table_rows_sw), (16,))
+
+
+if __name__ == '__main__':
+    unittest.main()